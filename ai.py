@@ -7,6 +7,8 @@ from gamestate import *
 import evaluation as e
 import opening_move as om
 import syzygy as sy
+import bitbase as bb
+from search_stats import SearchStats
 
 import time
 import math
@@ -18,7 +20,6 @@ class Ai:
 
         # Transposition table init
         self.tt_entry = {'value': 0, 'flag': '', 'depth': 0, 'best move': None}
-        self.tt_entry_q = {'value': 0, 'flag': ''}
 
         self.valid_moves_history = {}
         self.killer_moves = {}
@@ -26,12 +27,18 @@ class Ai:
         # Opening related parameters
         self.is_in_opening = is_playing_with_opening_book
 
-        # Count the nodes searched, only for development purposes.
-        self.counter = -1
+        # Nodes searched, cutoffs, prunes and timing for the latest search
+        self.search_stats = SearchStats()
 
         # Best moves from previous iterations
         self.best_moves = []
 
+        # Best lines found at each depth in Multi-PV analysis mode, {depth: [{'move', 'score', 'pv'}, ...]}
+        self.multipv_lines = {}
+
+        # Zobrist key of the position the search starts from, the root always needs a move
+        self.root_key = None
+
         # Used in the iterative deepening loop to stop after a certain time has passed
         self.timer = 0
 
@@ -40,11 +47,37 @@ class Ai:
         self.real_depth = 0
         self.min_search_depth = min_search_depth
 
+        # Callbacks for search events, each callback is called with a dict of info about the event
+        self.listeners = {'iteration started': [],  # {'depth'}
+                          'iteration completed': [],  # {'depth', 'move', 'score', 'pv', 'nodes', 'time'} ('lines' in analysis mode)
+                          'new best move': [],  # {'depth', 'move', 'score'}
+                          'search finished': []}  # {'move', 'score', 'depth', 'stats'}
+
+#  --------------------------------------------------------------------------------
+#                              Search events
+#  --------------------------------------------------------------------------------
+
+    def subscribe(self, event, callback):
+        self.listeners[event].append(callback)
+
+    def unsubscribe(self, event, callback):
+        self.listeners[event].remove(callback)
+
+    def emit(self, event, info):
+        for callback in self.listeners[event]:
+            callback(info)
+
+#  --------------------------------------------------------------------------------
+#                        Make a move for the AI
+#  --------------------------------------------------------------------------------
+
     def ai_make_move(self, gamestate):
 
         # Init variables
-        nodes = {}
         self.valid_moves_history = {}
+        self.search_stats.reset()
+        self.root_key = gamestate.zobrist_key
+        e.eval_cache.clear_if_settings_changed()
 
         for depth in range(gamestate.max_search_depth + 1):
             self.killer_moves[depth] = []
@@ -69,8 +102,8 @@ class Ai:
 
             # Try if position is in syzygy tablebase, only in endgames
             if not gamestate.midgame:
-                # Only the 3, 4 and 5 piece tablebases are currently implemented
-                if sum(gamestate.piece_dict[0].values()) + sum(gamestate.piece_dict[1].values()) <= 5:
+                # Root moves are ranked on DTZ, so both the WDL and DTZ tables are needed
+                if sy.has_table(gamestate, 'wdl') and sy.has_table(gamestate, 'dtz'):
                     endgame_move, evaluation, dtz = sy.find_endgame_move(gamestate)
                     if endgame_move:
 
@@ -81,9 +114,9 @@ class Ai:
                             endgame_move_2, evaluation_2 = self.negamax(gamestate, mate_depth, -math.inf, math.inf, start_color, False)
                             self.timer = time.time() - start_time
                             if abs(evaluation_2) >= 1e6:
-                                return endgame_move_2, evaluation_2
+                                return self.finish_search(endgame_move_2, evaluation_2)
 
-                        return endgame_move, evaluation
+                        return self.finish_search(endgame_move, evaluation)
 
             # Init parameters for iterative deepening
             self.tt_entry = {'value': 0, 'flag': '', 'depth': 0, 'best move': None, 'valid moves': []}
@@ -93,23 +126,26 @@ class Ai:
             time_start = time.time()
             for depth in range(1, gamestate.max_search_depth + 1):
 
+                # Events are only built if someone listens to them
+                if self.listeners['iteration started']:
+                    self.emit('iteration started', {'depth': depth})
+
                 move, evaluation = self.negamax(gamestate, depth, -math.inf, math.inf, start_color, False)
                 self.best_moves.append([move, evaluation])
 
                 time_end = time.time()
                 self.timer = time_end - time_start
 
-                nodes[depth] = self.counter - sum(nodes.values())
-                print('Depth: ', depth)
-                #  print('Nodes searched: ', nodes[depth])
-                print('Time spent: ', round(self.timer, 2), 's\n')
-
-                self.counter = -1
+                self.search_stats.end_iteration(depth)
+                if self.listeners['new best move'] and (len(self.best_moves) == 1 or move != self.best_moves[-2][0]):
+                    self.emit('new best move', {'depth': depth, 'move': move, 'score': evaluation})
+                if self.listeners['iteration completed']:
+                    self.emit('iteration completed', {'depth': depth, 'move': move, 'score': evaluation, 'pv': self.get_pv(gamestate, move, depth),
+                                                      'nodes': self.search_stats.iterations[-1]['nodes'], 'time': self.timer})
 
                 # Break if time has run out, if reached at least min depth, or if finding a mate in lowest number of moves
                 if (self.timer > s.max_search_time and depth >= self.min_search_depth) or (evaluation / 100) > 100:
                     break
-            print('----------------------------------')
 
             # Always return moves from an even number of depth, helps in some situation since quiescence search is not implemented
             self.max_depth = depth
@@ -122,7 +158,134 @@ class Ai:
                     move = self.best_moves[-2][0]
                     self.max_depth -= 1
 
-        return move, evaluation
+            # Optionally save the stats for batch runs
+            if s.search_stats_file:
+                self.search_stats.write_json_line(s.search_stats_file)
+
+        return self.finish_search(move, evaluation)
+
+    def finish_search(self, move, evaluation):
+        if self.listeners['search finished']:
+            self.emit('search finished', {'move': move, 'score': evaluation, 'depth': self.max_depth, 'stats': self.search_stats})
+
+        return move, evaluation, self.search_stats
+
+#  --------------------------------------------------------------------------------
+#                           Multi-PV analysis
+#  --------------------------------------------------------------------------------
+
+    def ai_analyse(self, gamestate, multipv=s.multipv):
+
+        # Init variables, the transposition table is shared between all passes and depths
+        self.valid_moves_history = {}
+        self.search_stats.reset()
+        self.tt_entry = {'value': 0, 'flag': '', 'depth': 0, 'best move': None, 'valid moves': []}
+        e.eval_cache.clear_if_settings_changed()
+        self.multipv_lines = {}
+        self.root_key = gamestate.zobrist_key
+
+        for depth in range(gamestate.max_search_depth + 1):
+            self.killer_moves[depth] = []
+
+        # Scores are given from the perspective of the side to move
+        color = -1 if gamestate.is_white_turn else 1
+
+        # Iterative deepening, each depth finds the best lines in one search of the root moves
+        lines = []
+        time_start = time.time()
+        for depth in range(1, gamestate.max_search_depth + 1):
+
+            if self.listeners['iteration started']:
+                self.emit('iteration started', {'depth': depth})
+
+            previous_moves = [line['move'] for line in lines]
+            lines = [{'move': move, 'score': evaluation, 'pv': self.get_pv(gamestate, move, depth)}
+                     for move, evaluation in self.negamax_root(gamestate, depth, color, multipv, previous_moves)]
+
+            self.multipv_lines[depth] = lines
+
+            self.timer = time.time() - time_start
+            self.search_stats.end_iteration(depth)
+
+            # Break if no legal moves exist
+            if not lines:
+                break
+
+            if self.listeners['new best move'] and (not previous_moves or lines[0]['move'] != previous_moves[0]):
+                self.emit('new best move', {'depth': depth, 'move': lines[0]['move'], 'score': lines[0]['score']})
+            if self.listeners['iteration completed']:
+                self.emit('iteration completed', {'depth': depth, 'move': lines[0]['move'], 'score': lines[0]['score'], 'pv': lines[0]['pv'],
+                                                  'nodes': self.search_stats.iterations[-1]['nodes'], 'time': self.timer, 'lines': lines})
+
+            # Break if time has run out
+            if self.timer > s.max_search_time and depth >= self.min_search_depth:
+                break
+
+        self.max_depth = self.real_depth = depth
+
+        if self.listeners['search finished']:
+            self.emit('search finished', {'move': lines[0]['move'] if lines else None, 'score': lines[0]['score'] if lines else None,
+                                          'depth': self.max_depth, 'stats': self.search_stats})
+
+        return lines, self.search_stats
+
+    def negamax_root(self, gamestate, depth, color, multipv, previous_moves):
+
+        # Don't search valid moves again if it has been done in last iteration
+        key = gamestate.zobrist_key
+        if key in self.valid_moves_history and self.valid_moves_history[key]:
+            children = self.valid_moves_history[key]
+        else:
+            children = gamestate.get_valid_moves()
+            self.valid_moves_history[key] = children
+            self.search_stats.movegen_calls += 1
+
+        # Search the lines from previous depth first, in the order they were found
+        children = self.sort_moves(gamestate, children, depth)
+        for move in reversed(previous_moves):
+            if move in children:
+                children.remove(move)
+                children.append(move)
+
+        # Keep the best multipv moves with exact scores as [(move, score)], best first. Until there are multipv of them every
+        # move gets a full window search. After that a move is searched with a null window at the worst kept score, and only
+        # searched again with an open window if it fails high and can replace that line.
+        lines = []
+        for child in reversed(children):
+            alpha = lines[-1][1] if len(lines) == multipv else -math.inf
+
+            gamestate.make_move(child)
+            if alpha == -math.inf:
+                score = -self.negamax(gamestate, depth - 1, -math.inf, math.inf, -color, True)[1]
+            else:
+                score = -self.negamax(gamestate, depth - 1, -alpha - 1, -alpha, -color, True)[1]
+                if score > alpha:
+                    score = -self.negamax(gamestate, depth - 1, -math.inf, -alpha, -color, True)[1]
+            gamestate.unmake_move()
+
+            if score > alpha:
+                lines.append((child, score))
+                lines.sort(key=lambda line: line[1], reverse=True)
+                del lines[multipv:]
+
+        return lines
+
+    def get_pv(self, gamestate, move, depth):
+
+        # Follow the best moves stored in the transposition table, as long as they are legal in the position
+        pv = [move]
+        gamestate.make_move(move)
+        while len(pv) < depth and gamestate.zobrist_key in self.tt_entry:
+            best_move = self.tt_entry[gamestate.zobrist_key]['best move']
+            if not best_move or best_move[:3] not in [valid_move[:3] for valid_move in gamestate.get_valid_moves()]:
+                break
+            pv.append(best_move)
+            gamestate.make_move(best_move)
+
+        for _ in pv:
+            gamestate.unmake_move()
+
+        return pv
 
 #  --------------------------------------------------------------------------------
 #                            Negamax function
@@ -131,29 +294,77 @@ class Ai:
     def negamax(self, gamestate, depth, alpha, beta, color, allow_nullmove):
         alpha_original = alpha
 
-        #  self.counter += 1
+        stats = self.search_stats
+        stats.nodes += 1
 
         # Transposition table lookup (https://en.wikipedia.org/wiki/Negamax#Negamax_with_alpha_beta_pruning_and_transposition_tables)
         key = gamestate.zobrist_key
+        stats.tt_probes += 1
         if key in self.tt_entry and self.tt_entry[key]['depth'] >= depth:
+            stats.tt_hits += 1
             if self.tt_entry[key]['flag'] == 'exact':
+                stats.tt_cutoffs += 1
                 return self.tt_entry[key]['best move'], self.tt_entry[key]['value']
             elif self.tt_entry[key]['flag'] == 'lowerbound':
                 alpha = max(alpha, self.tt_entry[key]['value'])
             elif self.tt_entry[key]['flag'] == 'upperbound':
                 beta = min(beta, self.tt_entry[key]['value'])
             if alpha >= beta:
+                stats.tt_cutoffs += 1
                 return self.tt_entry[key]['best move'], self.tt_entry[key]['value']
 
+        # Known draws from the KPK bitbase don't need to be searched
+        if s.use_bitbases and gamestate.material_key in bb.kpk_keys and key != self.root_key and not bb.probe_kpk(gamestate):
+            stats.bitbase_draws += 1
+            return None, 0
+
+        # Exact result from the syzygy WDL tables after a capture or pawn move, when the position has few enough pieces.
+        # Cursed wins and blessed losses are draws by the 50 move rule.
+        if s.use_syzygy_in_search and depth >= s.syzygy_probe_depth and gamestate.material['pieces'] <= s.syzygy_probe_pieces and \
+                key != self.root_key and (gamestate.move_log[-1][1][1] == 'p' or gamestate.move_log[-1][2] != '--'):
+            wdl = sy.probe_wdl(gamestate)
+            if wdl is not None:
+                stats.tablebase_cutoffs += 1
+                return None, s.tablebase_win_score + depth if wdl == 2 else -s.tablebase_win_score - depth if wdl == -2 else 0
+
         # Depth with quiescence search
         '''if depth == 0:
             if gamestate.piece_captured != '--':
                 return None, self.quiescence(gamestate, -beta, -alpha, -color, 0)
             else:
                 return None, e.evaluate(gamestate, depth) * color'''
-        # Depth = 0 without quiescence search
+        # Depth = 0 without quiescence search, only a bound is needed if the score is far outside the window
         if depth == 0:
-            return None, e.evaluate(gamestate, depth) * color
+            return None, e.evaluate_lazy(gamestate, depth, alpha, beta, color)
+
+        king_pos = gamestate.white_king_location if gamestate.is_white_turn else gamestate.black_king_location
+        is_in_check = gamestate.check_for_checks(king_pos)
+
+        # Static evaluation used for pruning decisions, not reliable when in check
+        static_eval = e.evaluate(gamestate, depth) * color if not is_in_check and (allow_nullmove or depth <= s.futility_depth) else None
+
+        # Static pruning near the leaves, not done when in check or when the window holds mate scores
+        # (https://www.chessprogramming.org/Futility_Pruning, https://www.chessprogramming.org/Razoring)
+        futility_pruning = False
+        if depth <= s.futility_depth and not is_in_check:
+
+            # Reverse futility pruning (static null move), position is so good that beta will hold anyway
+            if abs(beta) < 1e6 and static_eval - s.reverse_futility_margin * depth >= beta:
+                stats.reverse_futility_prunes += 1
+                return None, static_eval - s.reverse_futility_margin * depth
+
+            if abs(alpha) < 1e6:
+
+                # Razoring, position is so bad that only captures can bring it back up to alpha
+                if static_eval + s.razoring_margin[depth] < alpha:
+                    razor_alpha = alpha - s.razoring_margin[depth]
+                    score = self.quiescence(gamestate, razor_alpha, razor_alpha + 1, color, 0)
+                    if score <= razor_alpha:
+                        stats.razoring_prunes += 1
+                        return None, score
+
+                # Futility pruning, quiet moves can't raise the score above alpha
+                futility_pruning = static_eval + s.futility_margin[depth] <= alpha
 
         # Don't search valid moves again if it has been done in last iteration
         if key in self.valid_moves_history and self.valid_moves_history[key]:
@@ -161,6 +372,7 @@ class Ai:
         else:
             children = gamestate.get_valid_moves()
             self.valid_moves_history[key] = children
+            stats.movegen_calls += 1
 
         # Check if there is a checkmate or stalemate
         if gamestate.is_check_mate or gamestate.is_stale_mate:
@@ -169,27 +381,55 @@ class Ai:
         # Null move logic (https://hci.iwr.uni-heidelberg.de/system/files/private/downloads/1935772097/report_qingyang-cao_enhanced-forward-pruning.pdf,
         # http://mediocrechess.blogspot.com/2007/01/guide-null-moves.html)
         # https://open-chess.org/viewtopic.php?t=2994
-        if allow_nullmove and depth - 1 - s.R >= 0:  # and e.evaluate(gamestate, depth) >= beta - 50:  # and not using PV line
-            king_pos = gamestate.white_king_location if gamestate.is_white_turn else gamestate.black_king_location
-            if not gamestate.check_for_checks(king_pos):
+        # The reduction grows with depth and with how far static eval is above beta. Null move is not tried if the side
+        # to move only has king and pawns left, since zugzwang is common in those endgames.
+        if allow_nullmove and depth - 1 - s.R >= 0 and not is_in_check and static_eval >= beta:  # and not using PV line
+            if gamestate.material['non pawn pieces'][not gamestate.is_white_turn] > 0:
+                R = s.R + depth // s.null_move_depth_divisor + min(s.null_move_max_eval_reduction, int((static_eval - beta) // s.null_move_eval_divisor))
+                null_depth = max(0, depth - 1 - R)
+
                 gamestate.make_nullmove()
-                evaluation = -self.negamax(gamestate, depth - 1 - s.R, -beta, -beta + 1, -color, False)[1]
+                evaluation = -self.negamax(gamestate, null_depth, -beta, -beta + 1, -color, False)[1]
                 gamestate.unmake_nullmove()
 
+                # Verify the cutoff on deep nodes with a reduced search without null move (https://www.chessprogramming.org/Null_Move_Pruning#Verified_Null_Move_Pruning)
+                if evaluation >= beta and depth >= s.null_move_verification_depth:
+                    stats.null_move_verifications += 1
+                    evaluation = self.negamax(gamestate, null_depth + 1, beta - 1, beta, color, False)[1]
+
                 if evaluation >= beta:
+                    stats.null_move_prunes += 1
                     return None, evaluation
 
+        # Internal iterative deepening, if there is no best move from the transposition table in a PV node, do a reduced
+        # search first to find a good move to try first (https://www.chessprogramming.org/Internal_Iterative_Deepening)
+        if depth >= s.iid_depth and beta - alpha > 1 and (key not in self.tt_entry or not self.tt_entry[key]['best move']):
+            stats.iid_searches += 1
+            self.negamax(gamestate, depth - s.iid_reduction, alpha, beta, color, False)
+
         # Sort moves before Negamax
         children = self.sort_moves(gamestate, children, depth)
 
         # Negamax loop
         max_eval = -math.inf
+        best_move = None
+        moves_searched = 0
         for child in reversed(children):
 
-            gamestate.make_move(child)
+            # Futility pruning of quiet moves that don't give check, always search at least one move
+            if futility_pruning and best_move and gamestate.board[child[1]] == '--' and child[2] in ('no', 'ts', 'ck', 'cq'):
+                gamestate.make_move(child)
+                king_pos = gamestate.white_king_location if gamestate.is_white_turn else gamestate.black_king_location
+                if not gamestate.check_for_checks(king_pos):
+                    gamestate.unmake_move()
+                    stats.futility_prunes += 1
+                    continue
+            else:
+                gamestate.make_move(child)
 
             score = -self.negamax(gamestate, depth - 1, -beta, -alpha, -color, True)[1]
             gamestate.unmake_move()
+            moves_searched += 1
 
             if score > max_eval:
                 max_eval = score
@@ -198,6 +438,9 @@ class Ai:
 
             # Beta cutoff
             if beta <= alpha:
+                stats.beta_cutoffs += 1
+                if moves_searched == 1:
+                    stats.first_move_cutoffs += 1
 
                 # Killer moves
                 if gamestate.piece_captured == '--':
@@ -227,20 +470,11 @@ class Ai:
     def quiescence(self, gamestate, alpha, beta, color, moves):
 
         moves += 1
+        self.search_stats.qnodes += 1
 
-        # Check if value is in table
+        # Stand pat score, repeated positions are found in the evaluation cache
         key = gamestate.zobrist_key
-        if key in self.tt_entry_q:
-            if self.tt_entry_q[key]['flag'] == 'exact':
-                score = self.tt_entry_q[key]['value']
-            else:
-                score = color * e.evaluate(gamestate, 0)
-                self.tt_entry_q[key] = {'flag': 'exact'}
-                self.tt_entry_q[key]['value'] = score
-        else:
-            score = e.evaluate(gamestate, 0)
-            self.tt_entry_q[key] = {'flag': 'exact'}
-            self.tt_entry_q[key]['value'] = score
+        score = e.evaluate_lazy(gamestate, 0, alpha, beta, color)
 
         big_delta = s.mvv_lva_values[gamestate.piece_captured[1]] + 200
         if score < alpha - big_delta:
@@ -252,7 +486,7 @@ class Ai:
 
         # If having looked through 2 moves then stop and return value
         if moves >= 3:
-            return score
+            return alpha
 
         # Don't search valid moves again if it has been done in last iteration
         if key in self.valid_moves_history and self.valid_moves_history[key]:
@@ -260,20 +494,22 @@ class Ai:
         else:
             children = gamestate.get_valid_moves()
             self.valid_moves_history[key] = children
+            self.search_stats.movegen_calls += 1
 
         children = self.sort_moves(gamestate, children, 0)
 
-        for child in children:
+        for child in reversed(children):
 
             # Only look at capture moves (and later checks)
             if gamestate.board[child[1]] != '--':
                 gamestate.make_move(child)
                 score = -self.quiescence(gamestate, -beta, -alpha, -color, moves)
                 gamestate.unmake_move()
-        if score >= beta:
-            return beta
-        if score > alpha:
-            alpha = score
+
+                if score >= beta:
+                    return beta
+                if score > alpha:
+                    alpha = score
 
         return alpha
 
@@ -301,3 +537,16 @@ class Ai:
                 children.append(previous_best)
 
         return children
+
+#  --------------------------------------------------------------------------------
+#              Listeners that print the search progress to the terminal
+#  --------------------------------------------------------------------------------
+
+def print_iteration(info):
+    print('Depth: ', info['depth'])
+    print('Nodes searched: ', info['nodes'])
+    print('Time spent: ', round(info['time'], 2), 's\n')
+
+
+def print_search_finished(info):
+    print('----------------------------------')
@@ -0,0 +1,134 @@
+#  --------------------------------------------------------------------------------
+#          Evaluates many positions at once, using NumPy instead of a GameState
+#  --------------------------------------------------------------------------------
+import settings as s
+import material
+
+import numpy as np
+
+# Positions are arrays of 64 squares from a8 to h1 (same order as s.real_board_squares) with these piece codes
+piece_codes = {'--': 0,
+               'wp': 1, 'wN': 2, 'wB': 3, 'wR': 4, 'wQ': 5, 'wK': 6,
+               'bp': 7, 'bN': 8, 'bB': 9, 'bR': 10, 'bQ': 11, 'bK': 12}
+
+# Base + piece-square value for each piece code and square, in mid- and endgame. Black uses the flipped square.
+mid_game_values, end_game_values = np.zeros((13, 64)), np.zeros((13, 64))
+for piece, code in piece_codes.items():
+    if piece != '--':
+        for i, square in enumerate(s.real_board_squares):
+            square = square if piece[0] == 'w' else 120 - square + s.flip_board[square % 10]
+            mid_game_values[code, i] = s.piece_value_base_mid_game[piece[1]] + s.piece_value_mid_game[piece[1]][square]
+            end_game_values[code, i] = s.piece_value_base_end_game[piece[1]] + s.piece_value_end_game[piece[1]][square]
+
+# Phase value of each piece code
+phase_values = np.array([0] + [s.piece_phase_calc[piece[1]] for piece in list(piece_codes)[1:]])
+
+# Material key value of each piece code except empty squares
+material_key_values = np.array([material.piece_keys[piece] for piece in list(piece_codes)[1:]], dtype=np.int64)
+
+
+def board_to_array(board):
+    return np.array([piece_codes[board[square]] for square in s.real_board_squares], dtype=np.int8)
+
+
+def evaluate_batch(positions):
+
+    # Positions is an (n, 64) array, or a list of 64 square arrays. Returns an array with one score per position, with
+    # the same sign convention and value as evaluation.evaluate for a GameState created from that position.
+    # Checkmate/stalemate is not detected and the castling bonus is never given, since there is no move history.
+    positions = np.asarray(positions, dtype=np.intp).reshape(-1, 64)
+    squares = np.arange(64)
+
+    counts = piece_counts(positions)
+    midgame, endgame = game_phase(counts)
+
+    # Piece values (base and square dependent), interpolated between mid- and endgame
+    is_white, is_black = (positions >= 1) & (positions <= 6), positions >= 7
+    mid_values, end_values = mid_game_values[positions, squares], end_game_values[positions, squares]
+    white_score = (mid_values * is_white).sum(axis=1) * midgame + (end_values * is_white).sum(axis=1) * endgame
+    black_score = (mid_values * is_black).sum(axis=1) * midgame + (end_values * is_black).sum(axis=1) * endgame
+
+    # All other terms are a count times a bonus/punishment from settings
+    for name, (white, black) in term_counts(positions, counts, endgame).items():
+        white_score += white * getattr(s, name)
+        black_score += black * getattr(s, name)
+
+    # Scale down the score of the side that is ahead in drawish endgames, from the same material table as the GameState
+    score = black_score - white_score
+    material_keys = counts[:, 1:] @ material_key_values
+    for material_key in np.unique(material_keys):
+        entry = material.get_entry(int(material_key))
+        if entry['is scaled']:
+            rows = material_keys == material_key
+            score[rows] *= np.where(score[rows] > 0, entry['scale'][1], entry['scale'][0])
+
+    return score
+
+
+def is_scaled(positions):
+
+    # True for the positions in drawish endgames, where evaluate_batch scales down the score of the side that is ahead
+    material_keys, inverse = np.unique(piece_counts(positions)[:, 1:] @ material_key_values, return_inverse=True)
+    return np.array([material.get_entry(int(material_key))['is scaled'] for material_key in material_keys], dtype=bool)[inverse]
+
+
+def piece_counts(positions):
+
+    # Number of pieces of each piece code, shape (n, 13)
+    return np.stack([(positions == code).sum(axis=1) for code in range(13)], axis=1)
+
+
+def game_phase(counts):
+
+    # Same interpolation as in material.calculate_entry
+    phase = np.minimum(24, (counts * phase_values).sum(axis=1))
+    midgame = np.maximum(0, (phase - s.endgame_phase_limit) / (24 - s.endgame_phase_limit))
+    endgame = np.minimum(1, (24 - phase) / (24 - s.endgame_phase_limit))
+
+    return midgame, endgame
+
+
+def term_counts(positions, counts, endgame):
+
+    # Returns {settings name: (white count, black count)} for every evaluation term that is not a piece value
+    terms = {}
+    white_counts, black_counts = counts[:, 1:7], counts[:, 7:13]  # p, N, B, R, Q, K
+
+    # Pieces in front of undeveloped d and e pawns (d2/d3, e2/e3, d7/d6, e7/e6)
+    terms['blocking_d_e_pawn_punishment'] = (((positions[:, 51] == 1) & (positions[:, 43] != 0)).astype(int) + ((positions[:, 52] == 1) & (positions[:, 44] != 0)),
+                                             ((positions[:, 11] == 7) & (positions[:, 19] != 0)).astype(int) + ((positions[:, 12] == 7) & (positions[:, 20] != 0)))
+
+    # Bishop pair
+    terms['bishop_pair_bonus'] = (white_counts[:, 2] == 2, black_counts[:, 2] == 2)
+
+    # Pawns and rooks per file, shape (n, 8)
+    files = positions.reshape(-1, 8, 8)
+    white_pawns, black_pawns = (files == 1).sum(axis=1), (files == 7).sum(axis=1)
+    white_rooks, black_rooks = (files == 4).sum(axis=1), (files == 10).sum(axis=1)
+    white_has_pawn, black_has_pawn = white_pawns > 0, black_pawns > 0
+
+    # Double and isolated pawns
+    terms['double_pawn_punishment'] = ((white_pawns - white_has_pawn).sum(axis=1), (black_pawns - black_has_pawn).sum(axis=1))
+    terms['isolated_pawn_punishment'] = (isolated_files(white_has_pawn).sum(axis=1), isolated_files(black_has_pawn).sum(axis=1))
+
+    # Rook on open and semi-open file
+    terms['rook_on_semi_open_file_bonus'] = ((white_rooks * ~white_has_pawn).sum(axis=1), (black_rooks * ~black_has_pawn).sum(axis=1))
+    terms['rook_on_open_file_bonus'] = ((white_rooks * ~(white_has_pawn | black_has_pawn)).sum(axis=1),
+                                        (black_rooks * ~(white_has_pawn | black_has_pawn)).sum(axis=1))
+
+    # Endgame only. Knights worse and bishops better, knights better with lots of pawns, bishops and rooks worse.
+    is_endgame = endgame == 1
+    for name, white, black in [('knight_endgame_punishment', white_counts[:, 1], black_counts[:, 1]),
+                               ('bishop_endgame_bonus', white_counts[:, 2], black_counts[:, 2]),
+                               ('knight_pawn_bonus', white_counts[:, 1] * white_counts[:, 0], black_counts[:, 1] * black_counts[:, 0]),
+                               ('bishop_pawn_punishment', white_counts[:, 2] * white_counts[:, 0], black_counts[:, 2] * black_counts[:, 0]),
+                               ('rook_pawn_punishment', white_counts[:, 3] * white_counts[:, 0], black_counts[:, 3] * black_counts[:, 0])]:
+        terms[name] = (white * is_endgame, black * is_endgame)
+
+    return terms
+
+
+def isolated_files(has_pawn):
+    left = np.pad(has_pawn[:, :-1], ((0, 0), (1, 0)))
+    right = np.pad(has_pawn[:, 1:], ((0, 0), (0, 1)))
+    return has_pawn & ~left & ~right
@@ -0,0 +1,164 @@
+#  --------------------------------------------------------------------------------
+#       KPK bitbase, win or draw for every king and pawn vs king position
+#
+#  Generated by retrograde analysis the first time it is used and saved to s.bitbase_folder,
+#  after that it is loaded from disk. One bit per position, 1 if the side with the pawn wins.
+#
+#  Positions are normalized so that the pawn is white and on the a-d files. Squares are numbered
+#  rank * 8 + file with a1 = 0, and side to move is 0 for the side with the pawn.
+#  --------------------------------------------------------------------------------
+import settings as s
+import material
+
+from array import array
+import os
+
+# Material keys of king and pawn vs king, for white and black pawn
+kpk_keys = {material.piece_keys['wK'] + material.piece_keys['bK'] + material.piece_keys['wp'],
+            material.piece_keys['wK'] + material.piece_keys['bK'] + material.piece_keys['bp']}
+
+number_of_positions = 2 * 64 * 64 * 24
+invalid, unknown, draw, win = 0, 1, 2, 3
+
+king_moves = [[to_rank * 8 + to_file for to_rank in range(rank - 1, rank + 2) for to_file in range(file - 1, file + 2)
+               if 0 <= to_rank < 8 and 0 <= to_file < 8 and (to_rank, to_file) != (rank, file)] for rank in range(8) for file in range(8)]
+
+kpk = None
+
+
+def distance(square_1, square_2):
+    return max(abs(square_1 // 8 - square_2 // 8), abs(square_1 % 8 - square_2 % 8))
+
+
+def pawn_attacks(pawn):
+    return [pawn + 8 + d for d in (-1, 1) if 0 <= pawn % 8 + d < 8]
+
+
+def get_index(side_to_move, strong_king, weak_king, pawn):
+    return ((side_to_move * 64 + strong_king) * 64 + weak_king) * 24 + (pawn // 8 - 1) * 4 + pawn % 8
+
+
+def decode_index(index):
+    pawn_index, index = index % 24, index // 24
+    weak_king, index = index % 64, index // 64
+    strong_king, side_to_move = index % 64, index // 64
+    return side_to_move, strong_king, weak_king, (pawn_index // 4 + 1) * 8 + pawn_index % 4
+
+# ---------------------------------------------------------------------------------------------------------
+#                                  Generation
+# ---------------------------------------------------------------------------------------------------------
+
+
+def classify(side_to_move, strong_king, weak_king, pawn):
+
+    # Returns the result if it is known directly and the positions reachable in one move if not
+    if strong_king == weak_king or pawn in (strong_king, weak_king) or distance(strong_king, weak_king) <= 1 or \
+            (side_to_move == 0 and weak_king in pawn_attacks(pawn)):
+        return invalid, []
+
+    if side_to_move == 0:
+
+        # Pawn on the 7th rank that can promote without the queen being captured
+        promotion_square = pawn + 8
+        if pawn // 8 == 6 and strong_king != promotion_square and \
+                (distance(weak_king, promotion_square) > 1 or distance(strong_king, promotion_square) == 1):
+            return win, []
+
+        children = [get_index(1, square, weak_king, pawn) for square in king_moves[strong_king] if square != pawn and distance(square, weak_king) > 1]
+        if pawn // 8 < 6 and promotion_square not in (strong_king, weak_king):
+            children.append(get_index(1, strong_king, weak_king, promotion_square))
+            if pawn // 8 == 1 and promotion_square + 8 not in (strong_king, weak_king):
+                children.append(get_index(1, strong_king, weak_king, promotion_square + 8))
+
+        return (unknown, children) if children else (draw, [])
+
+    children = []
+    for square in king_moves[weak_king]:
+        if distance(square, strong_king) > 1 and square not in pawn_attacks(pawn):
+
+            # Capturing the undefended pawn is a draw
+            if square == pawn:
+                return draw, []
+            children.append(get_index(0, strong_king, square, pawn))
+
+    # No moves is checkmate or stalemate
+    if not children:
+        return (win, []) if weak_king in pawn_attacks(pawn) else (draw, [])
+
+    return unknown, children
+
+
+def generate_kpk():
+
+    results = bytearray(number_of_positions)
+    children = {}
+    for index in range(number_of_positions):
+        results[index], position_children = classify(*decode_index(index))
+        if results[index] == unknown:
+            children[index] = position_children
+
+    # Go through the unknown positions until no more can be resolved. The side with the pawn wins if any move wins,
+    # the other side draws if any move draws. Positions still unknown at the end are draws.
+    changed = True
+    while changed:
+        changed = False
+        for index, position_children in list(children.items()):
+            child_results = [results[child] for child in position_children]
+            if index < number_of_positions // 2:
+                result = win if win in child_results else draw if all(child == draw for child in child_results) else unknown
+            else:
+                result = draw if draw in child_results else win if all(child == win for child in child_results) else unknown
+
+            if result != unknown:
+                results[index] = result
+                del children[index]
+                changed = True
+
+    bits = array('B', [0]) * (number_of_positions // 8)
+    for index in range(number_of_positions):
+        if results[index] == win:
+            bits[index >> 3] |= 1 << (index & 7)
+
+    return bits
+
+
+def load_kpk():
+    global kpk
+
+    file_name = f'{s.bitbase_folder}/kpk.bin'
+    kpk = array('B')
+    if os.path.exists(file_name):
+        with open(file_name, 'rb') as file:
+            kpk.fromfile(file, number_of_positions // 8)
+    else:
+        kpk = generate_kpk()
+        os.makedirs(s.bitbase_folder, exist_ok=True)
+        with open(file_name, 'wb') as file:
+            kpk.tofile(file)
+
+# ---------------------------------------------------------------------------------------------------------
+#                                  Probing
+# ---------------------------------------------------------------------------------------------------------
+
+
+def probe_kpk(gamestate):
+
+    # Returns True if the side with the pawn wins, only call this for positions with a material key in kpk_keys
+    if kpk is None:
+        load_kpk()
+
+    pawn_square = next(square for square in s.real_board_squares if gamestate.board[square][1] == 'p')
+    is_white_strong = gamestate.board[pawn_square] == 'wp'
+    squares = [gamestate.white_king_location, gamestate.black_king_location, pawn_square]
+    if not is_white_strong:
+        squares = [gamestate.black_king_location, gamestate.white_king_location, pawn_square]
+
+    # Convert to rank * 8 + file, flip the board if the pawn is black and mirror if the pawn is on the e-h files
+    ranks = [9 - square // 10 if is_white_strong else square // 10 - 2 for square in squares]
+    files = [square % 10 - 1 for square in squares]
+    if files[2] > 3:
+        files = [7 - file for file in files]
+    strong_king, weak_king, pawn = [rank * 8 + file for rank, file in zip(ranks, files)]
+
+    index = get_index(0 if gamestate.is_white_turn == is_white_strong else 1, strong_king, weak_king, pawn)
+    return bool(kpk[index >> 3] >> (index & 7) & 1)
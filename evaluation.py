@@ -2,19 +2,154 @@
 #                 Evaluates a given board and returns a score
 #  --------------------------------------------------------------------------------
 import settings as s
+import bitbase as bb
+if s.use_nnue:
+    import nnue
 
+from array import array
+import random
+import time
 
-def evaluate(gamestate, depth):
 
-    # Initialize scores and other parameters
-    white_score = black_score = 0
+class EvalCache:
+
+    # Fixed size table indexed by the lowest bits of the Zobrist key. The full key is stored to verify the entry.
+    def __init__(self, size_bits):
+        self.mask = 2 ** size_bits - 1
+        self.keys = array('Q', [0]) * (self.mask + 1)
+        self.values = array('d', [0]) * (self.mask + 1)
+
+        # Evaluation settings the cached scores were calculated with
+        self.settings = eval_settings()
+
+        self.probes = self.hits = 0
+
+    def clear(self):
+        self.keys = array('Q', [0]) * (self.mask + 1)
+        self.settings = eval_settings()
+
+    def clear_if_settings_changed(self):
+        if self.settings != eval_settings():
+            self.clear()
+
+    def reset_stats(self):
+        self.probes = self.hits = 0
+
+    def hit_rate(self):
+        return self.hits / self.probes if self.probes else 0
+
+
+class PawnCache:
+
+    # Same layout as the evaluation cache but indexed by the pawn key. Stores the pawn structure scores for both sides
+    # and a bit mask per side with the files (columns) that have pawns on them.
+    def __init__(self, size_bits):
+        self.mask = 2 ** size_bits - 1
+        self.keys = array('Q', [0]) * (self.mask + 1)
+        self.white_scores = array('d', [0]) * (self.mask + 1)
+        self.black_scores = array('d', [0]) * (self.mask + 1)
+        self.white_files = array('H', [0]) * (self.mask + 1)
+        self.black_files = array('H', [0]) * (self.mask + 1)
+
+        self.probes = self.hits = 0
+
+    def reset_stats(self):
+        self.probes = self.hits = 0
+
+    def hit_rate(self):
+        return self.hits / self.probes if self.probes else 0
+
+
+def eval_settings():
+    return s.use_nnue, s.use_attack_terms, s.use_bitbases
 
-    # Check if in checkmate or stalemate
+
+eval_cache = EvalCache(s.eval_cache_size_bits)
+pawn_cache = PawnCache(s.pawn_cache_size_bits)
+
+# Number of lazy evaluations that were tried and that returned early without a full evaluation
+lazy_eval_stats = {'probes': 0, 'exits': 0}
+
+# Number of attack map calculations, the total time spent on them and the sum of each term as [white, black]
+attack_stats = {'calls': 0, 'time': 0, 'king attacks': [0, 0], 'center attacks': [0, 0], 'mobility': [0, 0]}
+
+# The castling bonus depends on the move history, which is not part of the Zobrist key. These are added to the key in the
+# evaluation cache for no castling, white castled, black castled and both castled.
+castled_keys = [0] + [random.getrandbits(64) for i in range(3)]
+
+
+def evaluate(gamestate, depth):
+
+    # Check if in checkmate or stalemate, these depend on the depth and are not cached
     if gamestate.is_check_mate:
         return 1e9 + depth if gamestate.is_white_turn else -1e9 - depth
     if gamestate.is_stale_mate:
         return 0
 
+    # Return the cached score if the position has been evaluated before
+    key = eval_key(gamestate)
+    index = key & eval_cache.mask
+    eval_cache.probes += 1
+    if eval_cache.keys[index] == key:
+        eval_cache.hits += 1
+        return eval_cache.values[index]
+
+    score = nnue.network.evaluate(gamestate.accumulator) if s.use_nnue else evaluate_position(gamestate)
+
+    # Known result from the KPK bitbase, a draw is 0 and a win gets a bonus on top of the evaluation to keep making progress
+    if s.use_bitbases and gamestate.material_key in bb.kpk_keys:
+        if not bb.probe_kpk(gamestate):
+            score = 0
+        else:
+            score += s.bitbase_win_bonus if gamestate.piece_dict[1]['p'] else -s.bitbase_win_bonus
+
+    eval_cache.keys[index] = key
+    eval_cache.values[index] = score
+
+    return score
+
+
+def evaluate_lazy(gamestate, depth, alpha, beta, color):
+
+    # Returns the score from the side to move point of view (color * evaluate). If the piece values alone are more than
+    # s.lazy_eval_margin outside the alpha-beta window, the other terms can't bring the score back inside it and the
+    # bound is returned directly. Cached positions, positions without piece values (NNUE), scaled endgames and bitbase
+    # positions are always fully evaluated.
+    key = eval_key(gamestate)
+    if not (gamestate.is_check_mate or gamestate.is_stale_mate or s.use_nnue or gamestate.material['is scaled'] or
+            s.use_bitbases and gamestate.material_key in bb.kpk_keys) and \
+            eval_cache.keys[key & eval_cache.mask] != key:
+        lazy_eval_stats['probes'] += 1
+        material = (gamestate.piece_values[1] - gamestate.piece_values[0]) * color
+        margin = s.lazy_eval_margin + s.lazy_eval_attack_margin if s.use_attack_terms else s.lazy_eval_margin
+        if material - margin >= beta:
+            lazy_eval_stats['exits'] += 1
+            return material - margin
+        if material + margin <= alpha:
+            lazy_eval_stats['exits'] += 1
+            return material + margin
+
+    return color * evaluate(gamestate, depth)
+
+
+def reset_attack_stats():
+    attack_stats['calls'] = attack_stats['time'] = 0
+    attack_stats['king attacks'], attack_stats['center attacks'], attack_stats['mobility'] = [0, 0], [0, 0], [0, 0]
+
+
+def eval_key(gamestate):
+
+    # Key in the evaluation cache, the castling bonus is only given in the first 30 moves (see evaluate_position)
+    if len(gamestate.move_log) < 30:
+        return gamestate.zobrist_key ^ castled_keys[gamestate.white_has_castled + 2 * gamestate.black_has_castled]
+    return gamestate.zobrist_key
+
+
+def evaluate_position(gamestate):
+
+    # Initialize scores and other parameters
+    white_score = black_score = 0
+
     # Piece values with base and piece-dependent values (updated in make/unmake move functions)
     white_score += gamestate.piece_values[0]
     black_score += gamestate.piece_values[1]
@@ -49,40 +184,49 @@ def evaluate(gamestate, depth):
     if gamestate.piece_dict[1]['B'] == 2:
         black_score += s.bishop_pair_bonus
 
-    # Double pawn punishment
-    white_pawns, black_pawns = set(gamestate.pawn_columns_list[0]), set(gamestate.pawn_columns_list[1])
-    white_score += (len(gamestate.pawn_columns_list[0]) - len(white_pawns)) * s.double_pawn_punishment
-    black_score += (len(gamestate.pawn_columns_list[1]) - len(black_pawns)) * s.double_pawn_punishment
-
-    # Isolated pawn punishment
-    white_score += len([i for i in white_pawns if i - 1 not in white_pawns and i + 1 not in white_pawns]) * s.isolated_pawn_punishment
-    black_score += len([i for i in black_pawns if i - 1 not in black_pawns and i + 1 not in black_pawns]) * s.isolated_pawn_punishment
-
-    # Rook on open and semi-open file bonus
+    # Pawn structure, only depends on the pawns so it is looked up in the pawn cache and calculated on a miss
+    index = gamestate.pawn_key & pawn_cache.mask
+    pawn_cache.probes += 1
+    if pawn_cache.keys[index] == gamestate.pawn_key:
+        pawn_cache.hits += 1
+    else:
+        evaluate_pawns(gamestate, index)
+    white_score += pawn_cache.white_scores[index]
+    black_score += pawn_cache.black_scores[index]
+    white_files, black_files = pawn_cache.white_files[index], pawn_cache.black_files[index]
+
+    # Rook on open and semi-open file bonus, rooks are not part of the pawn key so this is always calculated
     for rook in gamestate.rook_columns_list[0]:
-        if rook not in white_pawns:
+        if not white_files >> rook & 1:
             white_score += s.rook_on_semi_open_file_bonus
-            if rook not in black_pawns:
+            if not black_files >> rook & 1:
                 white_score += s.rook_on_open_file_bonus
     for rook in gamestate.rook_columns_list[1]:
-        if rook not in black_pawns:
+        if not black_files >> rook & 1:
             black_score += s.rook_on_semi_open_file_bonus
-            if rook not in white_pawns:
+            if not white_files >> rook & 1:
                 black_score += s.rook_on_open_file_bonus
 
-    # Bonus for attacking squares around the enemy king
-    '''white_score += gamestate.king_attacks_white * s.king_attack_bonus_factor
-    black_score += gamestate.king_attacks_black * s.king_attack_bonus_factor'''
+    if s.use_attack_terms:
+        king_attacks, center_attacks, mobility = attack_terms(gamestate)
+
+        # Bonus for attacking squares around the enemy king
+        white_score += king_attacks[0] * s.king_attack_bonus_factor
+        black_score += king_attacks[1] * s.king_attack_bonus_factor
+
+        # Bonus for the number of squares the pieces can move to
+        white_score += mobility[0] * s.mobility_factor
+        black_score += mobility[1] * s.mobility_factor
 
 # -------------------------------------------------------------------------------------------------
 #                              Midgame related functions
 # -------------------------------------------------------------------------------------------------
 
-    '''if gamestate.endgame < 1:
+    if s.use_attack_terms and gamestate.endgame < 1:
 
         # Bonus for attacking squares in the center
-        white_score += gamestate.center_attacks_white * s.center_attack_bonus_factor
-        black_score += gamestate.center_attacks_black * s.center_attack_bonus_factor'''
+        white_score += center_attacks[0] * s.center_attack_bonus_factor
+        black_score += center_attacks[1] * s.center_attack_bonus_factor
 
 # -------------------------------------------------------------------------------------------------
 #                               Endgame related functions
@@ -139,4 +283,75 @@ def evaluate(gamestate, depth):
                 if gamestate.piece_dict[1]['R'] == gamestate.piece_dict[1]['Q'] == 0 and gamestate.piece_dict[1]['B'] >= 1 and gamestate.piece_dict[1]['N'] >= 1:
                     pass'''
 
+    # Scale down the score of the side that is ahead in drawish endgames (see material.py)
+    if gamestate.material['is scaled']:
+        return (black_score - white_score) * gamestate.material['scale'][black_score > white_score]
+
     return black_score - white_score
+
+
+def evaluate_pawns(gamestate, index):
+
+    white_score = black_score = 0
+
+    # Double pawn punishment
+    white_pawns, black_pawns = set(gamestate.pawn_columns_list[0]), set(gamestate.pawn_columns_list[1])
+    white_score += (len(gamestate.pawn_columns_list[0]) - len(white_pawns)) * s.double_pawn_punishment
+    black_score += (len(gamestate.pawn_columns_list[1]) - len(black_pawns)) * s.double_pawn_punishment
+
+    # Isolated pawn punishment
+    white_score += len([i for i in white_pawns if i - 1 not in white_pawns and i + 1 not in white_pawns]) * s.isolated_pawn_punishment
+    black_score += len([i for i in black_pawns if i - 1 not in black_pawns and i + 1 not in black_pawns]) * s.isolated_pawn_punishment
+
+    # Store the scores and the files with pawns on them in the pawn cache
+    pawn_cache.keys[index] = gamestate.pawn_key
+    pawn_cache.white_scores[index] = white_score
+    pawn_cache.black_scores[index] = black_score
+    pawn_cache.white_files[index] = sum(1 << column for column in white_pawns)
+    pawn_cache.black_files[index] = sum(1 << column for column in black_pawns)
+
+
+def attack_terms(gamestate):
+
+    # Attack maps for both colors from the precomputed attack tables, sliding pieces stop at the first occupied square.
+    # Returns the king attacks, center attacks and mobility as [white, black] each.
+    start_time = time.perf_counter()
+    board, center = gamestate.board, s.center_attacks
+    king_attacks, center_attacks, mobility = [0, 0], [0, 0], [0, 0]
+    king_zones = (set(s.king_attack_squares[gamestate.black_king_location]), set(s.king_attack_squares[gamestate.white_king_location]))
+
+    for square in s.real_board_squares:
+        piece = board[square]
+        if piece == '--':
+            continue
+        color, piece_type = piece[0] == 'b', piece[1]
+
+        if piece_type == 'p':
+            attacked = s.pawn_attack_squares[color][square]
+        elif piece_type == 'N':
+            attacked = s.knight_attack_squares[square]
+        elif piece_type == 'K':
+            attacked = s.king_attack_squares[square]
+        else:
+            attacked = []
+            rays = s.ray_squares[square] if piece_type == 'Q' else s.ray_squares[square][:4] if piece_type == 'R' else s.ray_squares[square][4:]
+            for ray in rays:
+                for attack_square in ray:
+                    attacked.append(attack_square)
+                    if board[attack_square] != '--':
+                        break
+
+        king_attacks[color] += len(king_zones[color].intersection(attacked)) * s.piece_king_attack[piece_type]
+        center_attacks[color] += sum(map(center.__getitem__, attacked)) * s.piece_center_attack[piece_type]
+
+        # Mobility only for pieces, pawns and kings are handled by other terms
+        if piece_type not in 'pK':
+            mobility[color] += len([attack_square for attack_square in attacked if board[attack_square][0] != piece[0]])
+
+    attack_stats['calls'] += 1
+    attack_stats['time'] += time.perf_counter() - start_time
+    for term, values in (('king attacks', king_attacks), ('center attacks', center_attacks), ('mobility', mobility)):
+        attack_stats[term][0] += values[0]
+        attack_stats[term][1] += values[1]
+
+    return king_attacks, center_attacks, mobility
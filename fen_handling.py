@@ -4,163 +4,103 @@
 import settings as s
 import math
 
+# Lookup tables, computed once. The squares of each row from a8 to h1, an empty board to copy, the number of empty
+# squares for each digit and the enpassant squares by name (and the names by square).
+row_squares = [s.real_board_squares[row * 8:row * 8 + 8] for row in range(8)]
+empty_board = {square: '--' if square in s.real_board_squares else 'FF' for square in range(120)}
+empty_squares = {str(number): number for number in range(1, 9)}
+ep_squares = {letter + number: int(s.fen_numbers[number] + s.fen_letters[letter]) for letter in s.fen_letters for number in s.fen_numbers}
+ep_names = {square: name for name, square in ep_squares.items()}
+castling_letters = set('KQkq-')
+
+# FEN string of each row that has been serialized, by the pieces on the row. Cleared when it gets larger than s.fen_row_cache_size.
+row_strings = {}
+
 
 def run_fen_to_board(fen):
-    correct_fen = test_fen(fen)
-    if not correct_fen:
+    position = parse_fen(fen)
+    if position is None:
         print('Incorrect FEN format, please chose a valid FEN')
-        return None
-    else:
-        return fen_to_board(fen)
+    return position
 
 
 def test_fen(fen):
-
-    # Test if a value is given at all
-    if not fen:
-        return False
-
-    # Test board representation
-    fen_board = fen.split(' ')[0]
-    number = 0
-    for item in fen_board:
-        if item.isdigit():
-            number = number + int(item)        
-        elif item in 'pnbrqkPNBRQK':
-            number += 1         
-        elif item == '/':
-            if number != 8:
-                return False
-            number = 0       
-        else:
-            return False
-
-    # Test turn to move
-    try:
-        if fen.split(' ')[1] not in 'wb':
-            return False
-    except:
-        return False
-
-    # Test castling rights
-    try:
-        rights = fen.split(' ')[2]
-        if not 0 < len(rights) <= 4:
-            return False
-        for right in rights:
-            if right not in 'KQkq-':
-                return False
-    except:
-        return False
-
-    # Test enpassant square
-    try:
-        ep_square = fen.split(' ')[3]
-        if not ep_square:
-            return False
-        if ep_square[0] not in '-abcdefgh':
-            return False
-        if len(ep_square) == 2:
-            if ep_square[1] not in '3, 6':
-                return False
-        if len(ep_square) > 2:
-            return False
-    except:
-        return False
-        
-    # If all conditions are good, return True
-    return True
+    return parse_fen(fen) is not None
 
 
 def fen_to_board(fen):
+    return parse_fen(fen)
 
-    # Gamestate variables:
-    # Turn to move
-    is_white_turn = True if 'w' in fen.split(' ')[1] else False
-
-    # Castling rights
-    castling_rights = fen.split(' ')[2]
 
-    # Enpassant square
-    if fen.split(' ')[3] != '-':
-        ep_square = int(s.fen_numbers[fen.split(' ')[3][1]] + s.fen_letters[fen.split(' ')[3][0]])
-    else:
-        ep_square = None
-
-    # Get the board
-    board = {}
-    for square in range(120):
-        if square in s.real_board_squares:
-            board[square] = '--'
-        else:
-            board[square] = 'FF'
+def parse_fen(fen):
 
-    # Remove the move counters at the end of the FEN if exists
-    if fen[-1][0].isnumeric():
-        fen = ' '.join(fen.split(' ')[:-2])
+    # Validates the FEN and builds the board in the same pass. Returns (board, castling_rights, ep_square, 0, is_white_turn),
+    # or None if the FEN is not valid. The move counters at the end are optional and not used.
+    fields = fen.split() if fen else []
+    if not 4 <= len(fields) <= 6:
+        return None
+    fen_board, turn, castling_rights, ep_name = fields[:4]
 
-    # Extract the board representation and remove dashes
-    fen_board_temp = fen.split(' ')[0]
-    fen_board = fen_board_temp.replace('/', '')
+    if turn not in ('w', 'b') or not 0 < len(castling_rights) <= 4 or not castling_letters.issuperset(castling_rights) or ep_name not in ep_squares and ep_name != '-':
+        return None
 
-    # Loop through the board representation
-    number = 0
-    for item in fen_board:
+    rows = fen_board.split('/')
+    if len(rows) != 8:
+        return None
 
-        # If it is a number, go corresponding numbers ahead in squares
-        if item.isdigit():
-            number = number + int(item)
-        else:
-            square = s.real_board_squares[number]
-            board[square] = s.fen_to_piece[item]
-            number += 1
+    board = empty_board.copy()
+    for row, squares in zip(rows, row_squares):
+        column = 0
+        for item in row:
+            if item in empty_squares:
+                column += empty_squares[item]
+            elif item in s.fen_to_piece and column < 8:
+                board[squares[column]] = s.fen_to_piece[item]
+                column += 1
+            else:
+                return None
+        if column != 8:
+            return None
 
-    return board, castling_rights, ep_square, 0, is_white_turn
+    return board, castling_rights, ep_squares.get(ep_name), 0, turn == 'w'
 
 
 def gamestate_to_fen(gamestate):
 
-    # Go through board to find where all the pieces are located
-    fen = ''
-    number = 0
-    temp_number = 0
-    for square in gamestate.board:
-        piece = gamestate.board[square]
-        if piece != 'FF':
-            if piece == '--':
-                temp_number += 1
-                number += 1
-            else:
-                if temp_number:
-                    fen += str(temp_number)
-                    temp_number = 0
-                fen += s.piece_to_fen[piece]
-                number += 1
-            if number == 8:
-                if temp_number:
-                    fen += str(temp_number)
-                fen += '/'
-                number = temp_number = 0
-                
-    # Remove last '/'
-    fen = fen[:-1]
-
-    # Turn to move
-    fen += ' w ' if gamestate.is_white_turn else ' b '
-
-    # Castling rights
-    fen += gamestate.castling_rights if gamestate.castling_rights else '-'
-
-    # Enpassant square
-    if not gamestate.enpassant_square:
-        fen += ' -'
-    else:
-        fen += ' ' + s.fen_letters_ep[gamestate.enpassant_square % 10] + s.fen_numbers_ep[gamestate.enpassant_square // 10]
-                
-    # Halfmove clock
-    fen += ' ' + str(int(gamestate.fifty_move_clock * 2))
-
-    # Move counter
-    fen += ' ' + str(math.floor(gamestate.move_counter))
-            
-    return fen
+    # Each row is looked up from the pieces on it, and only run length encoded the first time it is seen
+    board = gamestate.board
+    if len(row_strings) > s.fen_row_cache_size:
+        row_strings.clear()
+
+    rows = []
+    for squares in row_squares:
+        pieces = tuple([board[square] for square in squares])
+        row = row_strings.get(pieces)
+        if row is None:
+            row = row_strings[pieces] = encode_row(pieces)
+        rows.append(row)
+
+    return ' '.join(['/'.join(rows),
+                     'w' if gamestate.is_white_turn else 'b',
+                     gamestate.castling_rights if gamestate.castling_rights else '-',
+                     ep_names.get(gamestate.enpassant_square, '-'),
+                     str(int(gamestate.fifty_move_clock * 2)),
+                     str(math.floor(gamestate.move_counter))])
+
+
+def encode_row(pieces):
+
+    # Pieces as FEN letters with each run of empty squares replaced by its length
+    row, empty = [], 0
+    for piece in pieces:
+        if piece == '--':
+            empty += 1
+        else:
+            if empty:
+                row.append(str(empty))
+                empty = 0
+            row.append(s.piece_to_fen[piece])
+    if empty:
+        row.append(str(empty))
+
+    return ''.join(row)
@@ -4,6 +4,9 @@
 
 import settings as s
 import fen_handling as fh
+import material
+if s.use_nnue:
+    import nnue
 
 import random
 
@@ -31,15 +34,20 @@ class GameState:
         self.piece_dict = [{'p': 0, 'N': 0, 'B': 0, 'R': 0, 'Q': 0, 'K': 0}, {'p': 0, 'N': 0, 'B': 0, 'R': 0, 'Q': 0, 'K': 0}]  # W, B
         self.init_piece_dict()
 
-        # Gamestate phase (midgame or endgame)
+        # Material key and its entry in the material table, with the gamestate phase (midgame or endgame)
         self.midgame, self.endgame = 0, 0
         self.gamestate_phase = 0
-        self.init_gamestate_phase()
+        self.material_key = material.init_material_key(self.piece_dict)
+        self.material = None
+        self.update_material()
 
         # Piece values (base and square dependent)
         self.piece_values = [0, 0]
         self.init_piece_values()
 
+        # NNUE first layer for the current position, only used with s.use_nnue
+        self.accumulator = nnue.network.refresh(self.board) if s.use_nnue else None
+
         # Init king positions
         self.white_has_castled = self.black_has_castled = False
         self.white_king_location, self.black_king_location = 0, 0
@@ -82,8 +90,12 @@ class GameState:
 
         self.zobrist_key = self.init_zobrist()
 
-        # Init the move log. [move, piece moved, piece_captured, castling rights, enpassant square, zobrist key, piece_values]
-        self.move_log = [[(0, 0, 0, 0), '--', '--', self.castling_rights, self.enpassant_square, self.zobrist_key, self.piece_values[:]]]
+        # Zobrist key of only the pawns on the board, used for the pawn structure cache in the evaluation
+        self.pawn_key = self.init_pawn_key()
+
+        # Init the move log. [move, piece moved, piece_captured, castling rights, enpassant square, zobrist key, piece_values, pawn key, accumulator, material key]
+        self.move_log = [[(0, 0, 0, 0), '--', '--', self.castling_rights, self.enpassant_square, self.zobrist_key, self.piece_values[:], self.pawn_key,
+                          self.accumulator, self.material_key]]
 
 # ---------------------------------------------------------------------------------------------------------
 #             Make and unmake move functions, Zobrist key
@@ -118,6 +130,12 @@ class GameState:
         self.zobrist_key ^= self.zobrist_board[end_square][self.piece_captured]  # Remove the piece that was on the end square
         self.zobrist_key ^= self.zobrist_board[end_square][self.piece_moved]  # Place the moved piece on its end square
 
+        # Update pawn key
+        if self.piece_moved[1] == 'p':
+            self.pawn_key ^= self.zobrist_board[start_square][self.piece_moved] ^ self.zobrist_board[end_square][self.piece_moved]
+        if self.piece_captured[1] == 'p':
+            self.pawn_key ^= self.zobrist_board[end_square][self.piece_captured]
+
         # Update the king position and has castled attributes
         if self.piece_moved == 'wK':
             self.white_king_location = end_square
@@ -152,6 +170,7 @@ class GameState:
 
                 self.zobrist_key ^= self.zobrist_board[end_square][self.piece_moved]  # Remove the pawn from end_square again since it now changed
                 self.zobrist_key ^= self.zobrist_board[end_square][f'{self.piece_moved[0]}{move_type[1]}']  # Place the promoted piece there instead
+                self.pawn_key ^= self.zobrist_board[end_square][self.piece_moved]  # The pawn is no longer on the board
 
                 # Capture to promotion or normal move?
                 if (start_square - end_square) % 10 > 0:
@@ -169,6 +188,10 @@ class GameState:
                 moved_piece_value_change_end = (-(s.piece_value_base_end_game['p'] + s.piece_value_end_game['p'][from_square]) +
                                                  (s.piece_value_base_end_game[f'{move_type[1]}'] + s.piece_value_end_game[f'{move_type[1]}'][to_square])) * self.endgame
 
+                # Update material key with the promoted piece
+                self.material_key += material.piece_keys[f'{self.piece_moved[0]}{move_type[1]}'] - material.piece_keys[self.piece_moved]
+                self.update_material()
+
             # Castling king side
             elif move_type == 'ck':
                 king_end_pos = 97 if self.is_white_turn else 27
@@ -211,6 +234,7 @@ class GameState:
                 self.board[end_square + d] = '--'
                 self.piece_captured = f'{color}p'
                 self.zobrist_key ^= self.zobrist_board[end_square + d][f'{color}p']
+                self.pawn_key ^= self.zobrist_board[end_square + d][f'{color}p']
 
                 # Captured piece square is now capture square - d since piece is not on the actual capture square
                 capture_square = -10
@@ -226,9 +250,8 @@ class GameState:
 
             self.piece_dict[self.is_white_turn][self.piece_captured[1]] -= 1
 
-            self.gamestate_phase -= s.piece_phase_calc[self.piece_captured[1]]
-            self.midgame = max(0, (self.gamestate_phase - s.endgame_phase_limit) / (24 - s.endgame_phase_limit))
-            self.endgame = min(1, (24 - self.gamestate_phase) / (24 - s.endgame_phase_limit))
+            self.material_key -= material.piece_keys[self.piece_captured]
+            self.update_material()
 
             capture_square += end_square if not self.is_white_turn else 120 - end_square + s.flip_board[end_square % 10]
 
@@ -250,6 +273,21 @@ class GameState:
         self.piece_values[color] += (moved_piece_value_change_mid + moved_piece_value_change_end) + (castle_piece_value_mid + castle_piece_value_end)
         self.piece_values[not color] -= (captured_piece_value_mid + captured_piece_value_end)
 
+        # Update the NNUE accumulator with the pieces removed from and added to the board
+        if s.use_nnue:
+            removed, added = [(self.piece_moved, start_square)], [(self.board[end_square], end_square)]
+            if move_type == 'ep':
+                removed.append((self.piece_captured, end_square + (10 if self.is_white_turn else -10)))
+            elif self.piece_captured != '--':
+                removed.append((self.piece_captured, end_square))
+            elif move_type == 'ck':
+                removed.append((f'{self.piece_moved[0]}R', end_square + 1))
+                added.append((f'{self.piece_moved[0]}R', end_square - 1))
+            elif move_type == 'cq':
+                removed.append((f'{self.piece_moved[0]}R', end_square - 2))
+                added.append((f'{self.piece_moved[0]}R', end_square + 1))
+            self.accumulator = nnue.network.update(self.accumulator, removed, added)
+
         # Update castling rights if there are any left
         if self.castling_rights:
             self.update_castling_rights(end_square)
@@ -260,7 +298,7 @@ class GameState:
 
         # Update move log
         self.move_log.append([move, self.piece_moved, self.piece_captured, self.castling_rights,
-                              self.enpassant_square, self.zobrist_key, self.piece_values[:]])
+                              self.enpassant_square, self.zobrist_key, self.piece_values[:], self.pawn_key, self.accumulator, self.material_key])
 
         # Update 50 move clock and check if it has reached 50 moves
         if self.piece_captured != '--' or self.piece_moved[1] == 'p':
@@ -301,12 +339,6 @@ class GameState:
             # Update piece dict
             self.piece_dict[self.is_white_turn][piece_captured[1]] += 1
 
-            # Update gamestate phase (opening, mid, endgame)
-            self.gamestate_phase += s.piece_phase_calc[piece_captured[1]]
-
-            self.midgame = max(0, (self.gamestate_phase - s.endgame_phase_limit) / (24 - s.endgame_phase_limit))
-            self.endgame = min(1, (24 - self.gamestate_phase) / (24 - s.endgame_phase_limit))
-
             # Update pawn and rook columns lists
             if piece_captured[1] == 'p':
                 self.pawn_columns_list[self.is_white_turn].append(end_square % 10)
@@ -375,12 +407,19 @@ class GameState:
                 d, color = (10, 'b') if self.is_white_turn else (-10, 'w')
                 self.board[end_square + d] = f'{color}p'
 
-        # Update things from the latest move [move, piece moved, piece_captured, castling rights, enpassant square, enpassant made, zobrist key, piece_values]
+        # Update things from the latest move [move, piece moved, piece_captured, castling rights, enpassant square, enpassant made, zobrist key, piece_values, pawn key, accumulator, material key]
         self.piece_moved, self.piece_captured = self.move_log[-1][1], self.move_log[-1][2]
         self.castling_rights = self.move_log[-1][3]
         self.enpassant_square = self.move_log[-1][4]
         self.zobrist_key = self.move_log[-1][5]
         self.piece_values = self.move_log[-1][6][:]
+        self.pawn_key = self.move_log[-1][7]
+        self.accumulator = self.move_log[-1][8]
+
+        # Update material and gamestate phase after captures and promotions
+        if self.material_key != self.move_log[-1][9]:
+            self.material_key = self.move_log[-1][9]
+            self.update_material()
 
         # Update 50 move clock if it is not at 0
         self.fifty_move_clock = max(0, self.fifty_move_clock - 0.5)
@@ -402,7 +441,7 @@ class GameState:
 
         # Update move log
         self.move_log.append([(0, 0, 'no', 0), self.piece_moved, self.piece_captured, self.castling_rights,
-                              self.enpassant_square, self.zobrist_key, self.piece_values[:]])
+                              self.enpassant_square, self.zobrist_key, self.piece_values[:], self.pawn_key, self.accumulator, self.material_key])
 
     def unmake_nullmove(self):
 
@@ -486,13 +525,14 @@ class GameState:
 # ---------------------------------------------------------------------------------------------------------
 
     def init_piece_values(self):
+
+        # Interpolate between mid- and endgame values with the phase of the start position, same as in make_move
         for square in self.board:
             color, piece = self.board[square][0], self.board[square][1]
-            if color == 'w':
-                self.piece_values[0] += s.piece_value_base_mid_game[piece] + s.piece_value_mid_game[piece][square]
-            elif color == 'b':
-                square_flipped = 120 - square + s.flip_board[square % 10]
-                self.piece_values[1] += s.piece_value_base_mid_game[piece] + s.piece_value_mid_game[piece][square_flipped]
+            if color in 'wb':
+                square = square if color == 'w' else 120 - square + s.flip_board[square % 10]
+                self.piece_values[color == 'b'] += (s.piece_value_base_mid_game[piece] + s.piece_value_mid_game[piece][square]) * self.midgame + \
+                                                   (s.piece_value_base_end_game[piece] + s.piece_value_end_game[piece][square]) * self.endgame
 
     def init_piece_dict(self):
         for square in self.board:
@@ -517,15 +557,11 @@ class GameState:
                 elif color == 'b':
                     self.pawn_columns_list[1].append(square % 10)
 
-    def init_gamestate_phase(self):
-        for square in self.board:
-            if self.board[square] not in ['--', 'FF']:
-                piece_type = self.board[square][1]
-                self.gamestate_phase += s.piece_phase_calc[piece_type]
+    def update_material(self):
 
-        # Endgame is 100% when gamestate is below s.endgame_phase_limit, else interpolate between the two phases
-        self.midgame = max(0, (self.gamestate_phase - s.endgame_phase_limit) / (24 - s.endgame_phase_limit))
-        self.endgame = min(1, (24 - self.gamestate_phase) / (24 - s.endgame_phase_limit))
+        # Gamestate phase, draw and endgame information for the current material (see material.py)
+        self.material = material.get_entry(self.material_key)
+        self.gamestate_phase, self.midgame, self.endgame = self.material['phase'], self.material['midgame'], self.material['endgame']
 
     def init_king_positions(self):
         for square in self.board:
@@ -568,6 +604,14 @@ class GameState:
 
         return zobrist_key
 
+    def init_pawn_key(self):
+        pawn_key = 0
+        for square in s.real_board_squares:
+            if self.board[square][1] == 'p':
+                pawn_key ^= self.zobrist_board[square][self.board[square]]
+
+        return pawn_key
+
 # ---------------------------------------------------------------------------------------------------------
 #                              Get valid moves
 # ---------------------------------------------------------------------------------------------------------
@@ -695,17 +739,10 @@ class GameState:
                     # Get corresponding moves for each piece
                     self.move_functions[self.board[square][1]](square, moves, False)
 
-        # Find if there is a draw by insufficient material (https://support.chess.com/article/128-what-does-insufficient-mating-material-mean)
-        if self.piece_dict[0]['p'] == self.piece_dict[1]['p'] == 0:
-            if self.piece_dict[0]['Q'] == self.piece_dict[0]['R'] == self.piece_dict[1]['Q'] == self.piece_dict[1]['R'] == 0:
-                if self.piece_dict[0]['N'] == self.piece_dict[0]['B'] == 0 and self.piece_dict[1]['B'] < 2 and (self.piece_dict[1]['B'] + self.piece_dict[1]['N']) < 2 or \
-                        self.piece_dict[1]['N'] == self.piece_dict[1]['B'] == 0 and self.piece_dict[0]['B'] < 2 and (self.piece_dict[0]['B'] + self.piece_dict[0]['N']) < 2 or \
-                        self.piece_dict[0]['N'] <= 2 and self.piece_dict[0]['B'] == 0 and self.piece_dict[1]['N'] <= 2 and self.piece_dict[1]['B'] == 0 or \
-                        self.piece_dict[0]['N'] == 1 and self.piece_dict[0]['B'] == 0 and self.piece_dict[1]['N'] == 0 and self.piece_dict[1]['B'] == 1 or \
-                        self.piece_dict[0]['N'] == 0 and self.piece_dict[0]['B'] == 1 and self.piece_dict[1]['N'] == 1 and self.piece_dict[1]['B'] == 0:
-
-                    self.is_stale_mate = True
-                    self.kind_of_stalemate = 'Insufficient material'
+        # Find if there is a draw by insufficient material, looked up in the material table
+        if self.material['insufficient material']:
+            self.is_stale_mate = True
+            self.kind_of_stalemate = 'Insufficient material'
 
         return moves
 
@@ -6,10 +6,13 @@ import settings as s
 import ai
 import evaluation as e
 import fen_handling as fh
+import opening_move as om
 
 import PySimpleGUI as sg
 import cProfile
 import ctypes
+import random
+import time
 import os
 import sys
 import contextlib
@@ -35,6 +38,9 @@ class Gui:
         self.screen = pygame.display.set_mode((s.win_width, s.win_height))
 
         self.ai = ai.Ai()
+        if s.print_search_info:
+            self.ai.subscribe('iteration completed', ai.print_iteration)
+            self.ai.subscribe('search finished', ai.print_search_finished)
 
         # Moves
         self.moves_list = []
@@ -59,8 +65,9 @@ class Gui:
         self.start_pop_up()
         self.is_started = self.running = True
 
-        # Init Gamestate and AI
+        # Init Gamestate and AI, scores in the evaluation cache are from earlier games
         self.gamestate = gs.GameState(self.start_fen, self.game_mode, self.is_ai_white, self.max_search_depth)
+        e.eval_cache.clear()
 
         # Flip board if AI is playing as white
         self.is_flipped = self.is_ai_white if self.game_mode == 'ai' else not self.is_white_turn
@@ -154,7 +161,12 @@ class Gui:
 
             # If move made and game not over, change to AI if that option is chosen.
             if (self.move_made, self.running, self.game_mode) == (True, True, 'ai'):
-                move, self.evaluation = self.ai.ai_make_move(self.gamestate)
+                move, self.evaluation, _ = self.ai.ai_make_move(self.gamestate)
+
+                # Wait for some time just to simulate the AI "thinking" during openings
+                if self.ai.is_in_opening and s.opening_move_delay:
+                    time.sleep(random.uniform(*s.opening_move_delay))
+
                 self.process_move(move)
                 self.process_eval()
 
@@ -322,7 +334,8 @@ class Gui:
     def process_eval(self):
 
         if self.ai.is_in_opening:
-            self.evaluation = 'Opening'
+            opening = om.get_opening(self.gamestate)
+            self.evaluation = f'Opening ({opening[0]})' if opening else 'Opening'
         else:
             if self.evaluation > 1e6:
                 self.evaluation = 'AI wins'
@@ -0,0 +1,66 @@
+#  --------------------------------------------------------------------------------
+#       Material key and the table of everything that only depends on material
+#  --------------------------------------------------------------------------------
+import settings as s
+
+# The material key holds the number of each piece in 4 bits per piece and color, it is updated in make_move
+pieces = ['wp', 'wN', 'wB', 'wR', 'wQ', 'wK', 'bp', 'bN', 'bB', 'bR', 'bQ', 'bK']
+piece_keys = {piece: 1 << (4 * i) for i, piece in enumerate(pieces)}
+
+# Entries are calculated the first time a material key is seen, after that it is a single lookup
+material_table = {}
+
+
+def init_material_key(piece_dict):
+    return sum(piece_dict[color == 'b'][piece_type] * piece_keys[f'{color}{piece_type}'] for color in 'wb' for piece_type in 'pNBRQK')
+
+
+def get_entry(material_key):
+    entry = material_table.get(material_key)
+    if entry is None:
+        entry = material_table[material_key] = calculate_entry(material_key)
+    return entry
+
+
+def calculate_entry(material_key):
+
+    # Piece counts for white and black, same layout as gamestate.piece_dict
+    piece_dict = [{piece[1]: material_key >> (4 * i) & 15 for i, piece in enumerate(pieces) if piece[0] == color} for color in 'wb']
+    white, black = piece_dict
+
+    # Game phase starts at 24 and is at most 24 also with promoted pieces. Endgame is 100% when at or below s.endgame_phase_limit.
+    phase = min(24, sum(s.piece_phase_calc[piece_type] * (white[piece_type] + black[piece_type]) for piece_type in 'pNBRQK'))
+    midgame = max(0, (phase - s.endgame_phase_limit) / (24 - s.endgame_phase_limit))
+    endgame = min(1, (24 - phase) / (24 - s.endgame_phase_limit))
+
+    # Draw by insufficient material (https://support.chess.com/article/128-what-does-insufficient-mating-material-mean)
+    insufficient_material = white['p'] == black['p'] == 0 and white['Q'] == white['R'] == black['Q'] == black['R'] == 0 and \
+        (white['N'] == white['B'] == 0 and black['B'] < 2 and (black['B'] + black['N']) < 2 or
+         black['N'] == black['B'] == 0 and white['B'] < 2 and (white['B'] + white['N']) < 2 or
+         white['N'] <= 2 and white['B'] == 0 and black['N'] <= 2 and black['B'] == 0 or
+         white['N'] == 1 and white['B'] == 0 and black['N'] == 0 and black['B'] == 1 or
+         white['N'] == 0 and white['B'] == 1 and black['N'] == 1 and black['B'] == 0)
+
+    # Number of pieces and the material signature as in the syzygy file names, white pieces first (e.g. KRPvKP)
+    number_of_pieces = sum(white.values()) + sum(black.values())
+    signature = 'v'.join(''.join(piece_type * pieces[piece_type] for piece_type in 'KQRBNp').upper() for pieces in piece_dict)
+
+    # Number of knights, bishops, rooks and queens, null move is not done without any of them
+    non_pawn_pieces = [pieces['N'] + pieces['B'] + pieces['R'] + pieces['Q'] for pieces in piece_dict]
+
+    # Scale factor for the score of each side when it is ahead. Without pawns, being up at most a minor piece is very hard to win.
+    scale = [1, 1]
+    non_pawn_material = [sum(pieces[piece_type] * s.piece_value_base_mid_game[piece_type] for piece_type in 'NBRQ') for pieces in piece_dict]
+    for color in (0, 1):
+        if piece_dict[color]['p'] == 0 and non_pawn_material[color] - non_pawn_material[not color] <= s.piece_value_base_mid_game['B']:
+            scale[color] = s.drawish_endgame_scale
+
+    return {'phase': phase,
+            'midgame': midgame,
+            'endgame': endgame,
+            'insufficient material': insufficient_material,
+            'pieces': number_of_pieces,
+            'signature': signature,
+            'non pawn pieces': non_pawn_pieces,
+            'scale': scale,
+            'is scaled': scale != [1, 1]}
@@ -0,0 +1,69 @@
+#  --------------------------------------------------------------------------------
+#       NNUE style evaluation, a small network on piece-square features
+#
+#  768 inputs (12 pieces x 64 squares) -> hidden layer (accumulator) -> clipped ReLU -> score.
+#  The accumulator is kept on the GameState and updated in make_move by adding and removing
+#  the weight rows of the pieces that moved, so only the last layer is calculated per evaluation.
+#
+#  Weights file (.npz):
+#    feature_weights (768, hidden), feature_bias (hidden), output_weights (hidden), output_bias ()
+#  Features are indexed as piece * 64 + square, pieces in the order below and squares from a8 to h1.
+#  The output is the score in centipawns from white's point of view.
+#  --------------------------------------------------------------------------------
+import settings as s
+
+import numpy as np
+
+pieces = ['wp', 'wN', 'wB', 'wR', 'wQ', 'wK', 'bp', 'bN', 'bB', 'bR', 'bQ', 'bK']
+
+# Feature index for each piece on each square of the 120 square board
+feature_index = {(piece, square): i * 64 + j for i, piece in enumerate(pieces) for j, square in enumerate(s.real_board_squares)}
+
+
+class Network:
+
+    def __init__(self, weights_file):
+        self.feature_weights, self.feature_bias, self.output_weights, self.output_bias = load_weights(weights_file)
+
+    def refresh(self, board):
+
+        # Calculate the accumulator from scratch for a board
+        features = [feature_index[(board[square], square)] for square in s.real_board_squares if board[square] != '--']
+        return self.feature_bias + self.feature_weights[features].sum(axis=0)
+
+    def update(self, accumulator, removed, added):
+
+        # Returns a new accumulator with the rows of removed and added (piece, square) features, the old one is kept in the move log
+        accumulator = accumulator - self.feature_weights[feature_index[removed[0]]]
+        for feature in removed[1:]:
+            accumulator -= self.feature_weights[feature_index[feature]]
+        for feature in added:
+            accumulator += self.feature_weights[feature_index[feature]]
+        return accumulator
+
+    def evaluate(self, accumulator):
+
+        # Same sign convention as evaluation.evaluate_position, positive is good for black
+        return -float(np.clip(accumulator, 0, 1) @ self.output_weights + self.output_bias)
+
+
+def load_weights(weights_file):
+    data = np.load(weights_file)
+    feature_weights = data['feature_weights'].astype(np.float32)
+    feature_bias = data['feature_bias'].astype(np.float32)
+    output_weights = data['output_weights'].astype(np.float32)
+    output_bias = float(data['output_bias'])
+
+    hidden = feature_bias.shape[0]
+    if feature_weights.shape != (768, hidden) or output_weights.shape != (hidden,):
+        raise ValueError(f'Invalid NNUE weights in {weights_file}: feature weights {feature_weights.shape}, '
+                         f'feature bias {feature_bias.shape}, output weights {output_weights.shape}')
+
+    return feature_weights, feature_bias, output_weights, output_bias
+
+
+def save_weights(weights_file, feature_weights, feature_bias, output_weights, output_bias):
+    np.savez(weights_file, feature_weights=feature_weights, feature_bias=feature_bias, output_weights=output_weights, output_bias=output_bias)
+
+
+network = Network(s.nnue_weights_file)
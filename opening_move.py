@@ -1,70 +1,317 @@
-import chess
-import chess.polyglot
+from chess.polyglot import POLYGLOT_RANDOM_ARRAY
+import numpy as np
 import random
+import struct
+import mmap
+import csv
 import os
-import time
+import re
 
-import fen_handling as fh
+import gamestate as gs
 import settings as s
 
+# Polyglot entries are 16 bytes: key, move, weight and learn, big endian and sorted on the key
+entry_type = np.dtype([('key', '>u8'), ('move', '>u2'), ('weight', '>u2'), ('learn', '>u4')])
+entry_struct = struct.Struct('>QHHI')
+
+# Polyglot Zobrist numbers for each piece on each square of the 120 square board. Polyglot orders the pieces as
+# black pawn, white pawn, black knight, ... and numbers the squares from a1 = 0 to h8 = 63.
+polyglot_piece_keys = {(f'{color}{piece_type}', square): POLYGLOT_RANDOM_ARRAY[64 * (2 * i + (color == 'w')) + 8 * (9 - square // 10) + square % 10 - 1]
+                       for i, piece_type in enumerate('pNBRQK') for color in 'wb' for square in s.real_board_squares}
+polyglot_castling_keys = {right: POLYGLOT_RANDOM_ARRAY[768 + i] for i, right in enumerate('KQkq')}
+polyglot_promotions = {1: 'pN', 2: 'pB', 3: 'pR', 4: 'pQ'}
+
+# All books merged into one file, opened once and memory mapped
+book = None
+
+# Total weight of the moves in a position in one book. The merged book holds the sum over all books for each move.
+book_weight_scale = 1000
+
+# Version of how the books are merged, part of the merged book file name. Increase it when merge_books changes so that old
+# merged books are not used.
+merged_book_version = 2
+merged_book_file = f'{os.path.splitext(s.merged_opening_book_file)[0]}_v{merged_book_version}.book'
+
+# Random number generator for picking book moves, the same seed gives the same moves
+book_random = random.Random(s.opening_book_seed)
+
+# Named openings by polyglot key, {key: [opening number, [(polyglot move, number of lines), ...]]}, and [(eco, name)] per opening number
+opening_index = None
+opening_names = None
+
+# Moves in standard algebraic notation, as in the opening name file
+san_regex = re.compile(r'O-O-O|O-O|([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=([NBRQ]))?')
+
 
 def make_opening_move(gamestate):
 
-    moves = []
-    fen = fh.gamestate_to_fen(gamestate)
+    # Book moves that are legal in the position, a hash collision in the book can give an illegal move.
+    # The same move can be stored in different ways (castling), so the weights are added up for the decoded move.
+    valid_moves = {move[:3] for move in gamestate.get_valid_moves()}
+    book_moves = find_book_moves(gamestate)
+    if s.use_opening_index_as_book:
+        book_moves += find_index_moves(gamestate)
 
-    board = chess.Board(fen)
+    moves = {}
+    for move, weight in book_moves:
+        if move in valid_moves:
+            moves[move] = moves.get(move, 0) + weight
 
-    for subdir, dirs, files in os.walk('opening_book'):
-        for file in files:
-            ext = os.path.splitext(file)[-1].lower()
-            if ext in '.bin':
-                with chess.polyglot.open_reader(os.path.join(subdir, file)) as reader:
-                    for i, entry in enumerate(reader.find_all(board)):
-                        moves.append(entry.move)
-
-                        # Only pick from the most common openings
-                        if i == 2:
-                            break
-
-    # Pick a random move if exists, else return None
-    if moves:
-        random_move = random.choice(moves)
-    else:
+    # Pick a random move by weight if exists, else return None
+    if not moves:
         return None
 
-    # Convert the move to the right format
-    move = process_move(gamestate, random_move)
+    return book_random.choices(list(moves), weights=list(moves.values()))[0]
 
-    # Wait for some time just so simulate the AI "thinking" during openings
-    time.sleep(random.uniform(0.5, 1.5))
 
-    return move
+def find_book_moves(gamestate):
 
+    # Binary search in the merged book, returns [(move, weight)] with the most common moves from each book
+    if book is None:
+        open_book()
 
-def process_move(gamestate, move):
+    key = polyglot_key(gamestate)
+    low, high = 0, len(book) // entry_struct.size
+    while low < high:
+        middle = (low + high) // 2
+        if entry_struct.unpack_from(book, middle * entry_struct.size)[0] < key:
+            low = middle + 1
+        else:
+            high = middle
 
-    move = str(move)
-    move_type = 'no'
-    start_square = s.convert_textual[move[1]] + int(s.fen_letters[move[0]])
-    end_square = s.convert_textual[move[3]] + int(s.fen_letters[move[2]])
+    moves = []
+    for offset in range(low * entry_struct.size, len(book), entry_struct.size):
+        entry_key, raw_move, weight, learn = entry_struct.unpack_from(book, offset)
+        if entry_key != key:
+            break
+        moves.append((decode_move(gamestate, raw_move), weight))
+
+    return moves
+
+
+def polyglot_key(gamestate):
+
+    # Zobrist key of the position as defined by the polyglot book format
+    key = 0
+    for square in s.real_board_squares:
+        if gamestate.board[square] != '--':
+            key ^= polyglot_piece_keys[(gamestate.board[square], square)]
 
+    for right, castling_key in polyglot_castling_keys.items():
+        if right in gamestate.castling_rights:
+            key ^= castling_key
+
+    # The en passant file is only included if a pawn of the side to move can capture en passant
+    if gamestate.enpassant_square:
+        color = 'w' if gamestate.is_white_turn else 'b'
+        pawn_row = gamestate.enpassant_square + (10 if gamestate.is_white_turn else -10)
+        if f'{color}p' in (gamestate.board[pawn_row - 1], gamestate.board[pawn_row + 1]):
+            key ^= POLYGLOT_RANDOM_ARRAY[772 + gamestate.enpassant_square % 10 - 1]
+
+    if gamestate.is_white_turn:
+        key ^= POLYGLOT_RANDOM_ARRAY[780]
+
+    return key
+
+
+def decode_move(gamestate, raw_move):
+
+    # Polyglot moves are to square (bits 0-5), from square (bits 6-11) and promotion piece (bits 12-14)
+    start_square = 91 + (raw_move >> 6 & 7) - 10 * (raw_move >> 9 & 7)
+    end_square = 91 + (raw_move & 7) - 10 * (raw_move >> 3 & 7)
     piece = gamestate.board[start_square]
 
-    if piece[1] == 'p' and abs(start_square - end_square) == 20:
+    move_type = 'no'
+    if raw_move >> 12 & 7:
+        move_type = polyglot_promotions[raw_move >> 12 & 7]
+    elif piece[1] == 'p' and abs(start_square - end_square) == 20:
         move_type = 'ts'
-    if piece[1] == 'p' and (start_square % 10 - end_square % 10) != 0 and gamestate.board[end_square] == '--':
+    elif piece[1] == 'p' and start_square % 10 != end_square % 10 and gamestate.board[end_square] == '--':
         move_type = 'ep'
-    if piece[1] == 'p' and end_square in range(21, 29) or end_square in range(91, 99):
-        move_type = 'pQ'
-    if piece[1] == 'K' and start_square - end_square == 2:
-        move_type = 'cq'
-    if piece[1] == 'K' and start_square - end_square == -2:
-        move_type = 'ck'
+
+    # Castling is stored as the king moving to the square of the rook, some books use the king's end square instead
+    elif piece[1] == 'K' and (gamestate.board[end_square] == f'{piece[0]}R' or abs(start_square - end_square) == 2):
+        move_type = 'ck' if end_square > start_square else 'cq'
+        end_square = start_square + 2 if end_square > start_square else start_square - 2
 
     return start_square, end_square, move_type
 
 
+def encode_move(move):
+
+    # Engine move to polyglot move, castling is written as the king moving to the square of the rook
+    start_square, end_square, move_type = move[:3]
+    if move_type == 'ck':
+        end_square = start_square + 3
+    elif move_type == 'cq':
+        end_square = start_square - 4
+    promotion = {move_type: number for number, move_type in polyglot_promotions.items()}.get(move_type, 0)
+
+    return promotion << 12 | polyglot_square(start_square) << 6 | polyglot_square(end_square)
+
+
+def polyglot_square(square):
+    return 8 * (9 - square // 10) + square % 10 - 1
+
+
+def open_book():
+    global book
+
+    book_files = []
+    for subdir, dirs, files in os.walk(s.opening_book_folder):
+        for file in files:
+            if os.path.splitext(file)[-1].lower() == '.bin':
+                book_files.append(os.path.join(subdir, file))
+
+    # Rebuild the merged book if it is missing for this version or older than any of the books
+    if not os.path.exists(merged_book_file) or any(os.path.getmtime(file) > os.path.getmtime(merged_book_file) for file in book_files):
+        merge_books(sorted(book_files), merged_book_file)
 
+    with open(merged_book_file, 'rb') as file:
+        book = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
 
 
+def merge_books(book_files, merged_file):
+
+    keys, moves, weights = [], [], []
+    for file in book_files:
+        book = np.fromfile(file, dtype=entry_type)
+        book = book[book['weight'] > 0]
+
+        # Only pick from the most common openings, the first 3 entries for each position in each book
+        is_new_key = np.concatenate(([True], book['key'][1:] != book['key'][:-1]))
+        index = np.arange(len(book))
+        first_index = np.maximum.accumulate(np.where(is_new_key, index, 0))
+        book = book[index - first_index < 3]
+
+        # Weight as a share of the position in this book, so that all books count the same
+        _, position = np.unique(book['key'], return_inverse=True)
+        keys.append(book['key'])
+        moves.append(book['move'])
+        weights.append(book['weight'] / np.bincount(position, weights=book['weight'])[position])
+
+    # Add up the weights of the same move in different books
+    keys, moves, weights = np.concatenate(keys).astype(np.uint64), np.concatenate(moves).astype(np.uint16), np.concatenate(weights)
+    order = np.lexsort((moves, keys))
+    keys, moves, weights = keys[order], moves[order], weights[order]
+    first_index = np.nonzero(np.concatenate(([True], (keys[1:] != keys[:-1]) | (moves[1:] != moves[:-1]))))[0]
+    keys, moves, weights = keys[first_index], moves[first_index], np.add.reduceat(weights, first_index)
+
+    # Sorted on the key and then the most common move first, as in polyglot books
+    order = np.lexsort((-weights, keys))
+    entries = np.zeros(len(order), dtype=entry_type)
+    entries['key'], entries['move'] = keys[order], moves[order]
+    entries['weight'] = np.maximum(1, np.round(weights[order] * book_weight_scale))
+    entries.tofile(merged_file)
+
+
+# ---------------------------------------------------------------------------------------------------------
+#                                  Named openings
+# ---------------------------------------------------------------------------------------------------------
+
+
+def get_opening(gamestate):
+
+    # Returns (eco, name) of the opening in the position, or None if it is not in the opening name file
+    if opening_index is None:
+        load_opening_index()
+
+    entry = opening_index.get(polyglot_key(gamestate))
+    return opening_names[entry[0]] if entry and entry[0] >= 0 else None
+
+
+def find_index_moves(gamestate):
+
+    # The 3 moves played the most from the position in the named openings, as [(move, weight)]. Used as an extra book.
+    if opening_index is None:
+        load_opening_index()
+
+    entry = opening_index.get(polyglot_key(gamestate))
+    if not entry or not entry[1]:
+        return []
+    moves = sorted(entry[1], key=lambda move: move[1], reverse=True)[:3]
+    total_lines = sum(lines for raw_move, lines in moves)
+    return [(decode_move(gamestate, raw_move), lines / total_lines * book_weight_scale) for raw_move, lines in moves]
+
+
+def load_opening_index():
+    global opening_index, opening_names
+
+    # Rebuild the index if it is missing or older than the opening name file
+    if not os.path.exists(s.opening_index_file) or os.path.getmtime(s.opening_index_csv_file) > os.path.getmtime(s.opening_index_file):
+        build_opening_index(s.opening_index_csv_file, s.opening_index_file)
+
+    data = np.load(s.opening_index_file)
+    opening_names = list(zip(data['eco'].tolist(), data['names'].tolist()))
+    opening_index = {}
+    for key, raw_move, lines, opening in zip(data['keys'].tolist(), data['moves'].tolist(), data['lines'].tolist(), data['openings'].tolist()):
+        entry = opening_index.setdefault(key, [opening, []])
+        if raw_move:
+            entry[1].append((raw_move, lines))
+
+
+def build_opening_index(csv_file, index_file):
+
+    # Replays every opening in the file and stores each position reached, with the opening name and the moves played from it
+    with open(csv_file, newline='') as file:
+        rows = list(csv.reader(file))[1:]
+
+    gamestate = gs.GameState(s.start_fen, 'ai', False, 0)
+    names, lines, endings, continuations = [], [], {}, {}
+    illegal_lines = 0
+    for eco, name, line in rows:
+        opening = len(names)
+        names.append((eco, name))
+
+        line_keys = [polyglot_key(gamestate)]
+        for match in san_regex.finditer(line):
+            move = san_to_move(gamestate, match)
+            if not move:
+                illegal_lines += 1
+                break
+            moves = continuations.setdefault(line_keys[-1], {})
+            moves[encode_move(move)] = moves.get(encode_move(move), 0) + 1
+            gamestate.make_move(move)
+            line_keys.append(polyglot_key(gamestate))
+        else:
+            endings.setdefault(line_keys[-1], opening)
+        lines.append(line_keys)
+
+        for _ in range(len(line_keys) - 1):
+            gamestate.unmake_move()
+
+    if illegal_lines:
+        print(f'{illegal_lines} openings in {csv_file} have an illegal move, they are only used up to that move')
+
+    # A position gets the name of the opening that ends in it, or else the name of the last named position before it.
+    # Positions before the first named one have no name (-1).
+    positions = {}
+    for line_keys in lines:
+        opening = -1
+        for key in line_keys:
+            opening = endings.get(key, opening)
+            positions.setdefault(key, opening)
+
+    # One row per position and move, positions without moves get move 0
+    rows = sorted((key, raw_move, lines, positions[key]) for key in positions for raw_move, lines in (continuations.get(key) or {0: 0}).items())
+    keys, moves, lines, openings = zip(*rows)
+    np.savez(index_file, keys=np.array(keys, dtype=np.uint64), moves=np.array(moves, dtype=np.uint16), lines=np.array(lines, dtype=np.uint16),
+             openings=np.array(openings, dtype=np.int16), eco=np.array([eco for eco, name in names]), names=np.array([name for eco, name in names]))
+
+
+def san_to_move(gamestate, match):
+
+    # Finds the valid move that matches a san_regex match, None if there is no or more than one such move
+    valid_moves = gamestate.get_valid_moves()
+    if match.group() in ('O-O', 'O-O-O'):
+        move_type = 'ck' if match.group() == 'O-O' else 'cq'
+        moves = [move for move in valid_moves if move[2] == move_type]
+    else:
+        piece_type, start_file, start_rank, end_square, promotion = match.groups()
+        end_square = s.convert_textual[end_square[1]] + int(s.fen_letters[end_square[0]])
+        moves = [move for move in valid_moves if move[1] == end_square and gamestate.board[move[0]][1] == (piece_type or 'p') and
+                 (not start_file or move[0] % 10 == int(s.fen_letters[start_file])) and
+                 (not start_rank or move[0] // 10 == s.convert_textual[start_rank] // 10) and
+                 (move[2] == f'p{promotion}' if promotion else move[2] not in polyglot_promotions.values())]
+
+    return moves[0] if len(moves) == 1 else None
@@ -0,0 +1,126 @@
+#  --------------------------------------------------------------------------------
+#                   Statistics collected during a search
+#  --------------------------------------------------------------------------------
+import evaluation as e
+import syzygy as sy
+
+import json
+import time
+
+
+class SearchStats:
+
+    def __init__(self):
+
+        # Node counters, for the negamax and the quiescence search
+        self.nodes = 0
+        self.qnodes = 0
+
+        # Transposition table probes, how many that found an entry and how many that returned a value directly
+        self.tt_probes = 0
+        self.tt_hits = 0
+        self.tt_cutoffs = 0
+
+        # Beta cutoffs and how many of them that happened on the first move searched (measures move ordering quality)
+        self.beta_cutoffs = 0
+        self.first_move_cutoffs = 0
+
+        # Pruning
+        self.null_move_prunes = 0
+        self.null_move_verifications = 0
+        self.futility_prunes = 0
+        self.reverse_futility_prunes = 0
+        self.razoring_prunes = 0
+
+        # Reduced searches done to find a best move when the transposition table has none
+        self.iid_searches = 0
+
+        # Nodes that returned a draw directly from the KPK bitbase
+        self.bitbase_draws = 0
+
+        # Nodes that returned an exact win, draw or loss from the syzygy tablebases
+        self.tablebase_cutoffs = 0
+
+        # Number of times moves are generated through gamestate.get_valid_moves
+        self.movegen_calls = 0
+
+        # One entry per completed iteration, [{'depth', 'nodes', 'qnodes', 'time', 'nps'}, ...]
+        self.iterations = []
+        self.start_time = time.time()
+
+    def reset(self):
+        self.__init__()
+        e.eval_cache.reset_stats()
+        e.pawn_cache.reset_stats()
+        e.lazy_eval_stats['probes'] = e.lazy_eval_stats['exits'] = 0
+        e.reset_attack_stats()
+        sy.reset_stats()
+
+    def end_iteration(self, depth):
+
+        # Nodes for this iteration are the nodes searched since the previous iteration ended
+        nodes = self.nodes - sum(iteration['nodes'] for iteration in self.iterations)
+        qnodes = self.qnodes - sum(iteration['qnodes'] for iteration in self.iterations)
+        time_spent = time.time() - self.start_time - sum(iteration['time'] for iteration in self.iterations)
+
+        self.iterations.append({'depth': depth,
+                                'nodes': nodes,
+                                'qnodes': qnodes,
+                                'time': time_spent,
+                                'nps': int((nodes + qnodes) / time_spent) if time_spent > 0 else 0})
+
+    def first_move_cutoff_ratio(self):
+        return self.first_move_cutoffs / self.beta_cutoffs if self.beta_cutoffs else 0
+
+    def attack_term_averages(self, term):
+
+        # Average of an attack term over all attack map calculations, as [white, black]
+        calls = e.attack_stats['calls']
+        return [round(value / calls, 2) if calls else 0 for value in e.attack_stats[term]]
+
+    def nps(self):
+        time_spent = time.time() - self.start_time if not self.iterations else sum(iteration['time'] for iteration in self.iterations)
+        return int((self.nodes + self.qnodes) / time_spent) if time_spent > 0 else 0
+
+    def to_dict(self):
+        return {'nodes': self.nodes,
+                'qnodes': self.qnodes,
+                'tt probes': self.tt_probes,
+                'tt hits': self.tt_hits,
+                'tt cutoffs': self.tt_cutoffs,
+                'beta cutoffs': self.beta_cutoffs,
+                'first move cutoff ratio': round(self.first_move_cutoff_ratio(), 3),
+                'null move prunes': self.null_move_prunes,
+                'null move verifications': self.null_move_verifications,
+                'futility prunes': self.futility_prunes,
+                'reverse futility prunes': self.reverse_futility_prunes,
+                'razoring prunes': self.razoring_prunes,
+                'iid searches': self.iid_searches,
+                'bitbase draws': self.bitbase_draws,
+                'tablebase cutoffs': self.tablebase_cutoffs,
+                'movegen calls': self.movegen_calls,
+                'eval cache probes': e.eval_cache.probes,
+                'eval cache hits': e.eval_cache.hits,
+                'eval cache hit rate': round(e.eval_cache.hit_rate(), 3),
+                'pawn cache probes': e.pawn_cache.probes,
+                'pawn cache hits': e.pawn_cache.hits,
+                'pawn cache hit rate': round(e.pawn_cache.hit_rate(), 3),
+                'lazy eval probes': e.lazy_eval_stats['probes'],
+                'lazy eval exits': e.lazy_eval_stats['exits'],
+                'attack map calls': e.attack_stats['calls'],
+                'attack map time': round(e.attack_stats['time'], 3),
+                'average king attacks': self.attack_term_averages('king attacks'),
+                'average center attacks': self.attack_term_averages('center attacks'),
+                'average mobility': self.attack_term_averages('mobility'),
+                'tablebase probes': sy.probe_stats['probes'],
+                'tablebase cache hits': sy.probe_stats['hits'],
+                'tablebase missing': sy.probe_stats['missing'],
+                'tablebase probe time': round(sy.probe_stats['time'], 3),
+                'nps': self.nps(),
+                'iterations': self.iterations}
+
+    def write_json_line(self, file_name):
+
+        # Append the stats as one JSON object per line, easy to stream and parse in batch runs
+        with open(file_name, 'a') as file:
+            file.write(json.dumps(self.to_dict()) + '\n')
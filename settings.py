@@ -12,6 +12,7 @@ sq_size = 85
 # Negamax parameters for iterative deepening
 max_search_time = 5  # When it reaches more than x seconds for a move it makes a last search
 min_search_depth = 6  # Choose to always search for at least a certain number of depth
+multipv = 3  # Number of best lines to find in analysis mode
 max_search_depth_hard = 600
 max_search_depth_normal = 4
 max_search_depth_easy = 2
@@ -24,6 +25,17 @@ level = {max_search_depth_hard: 'Hard',
 play_with_opening_book = True
 max_opening_moves = 10
 
+# Folder with polyglot (.bin) opening books. They are merged into one file the first time the book is used and again if a book changes.
+opening_book_folder = 'opening_book'
+merged_opening_book_file = 'opening_book/merged_book.book'
+
+# Named openings (ECO code, name and moves). They are compiled into an index by position the first time it is used.
+opening_index_csv_file = 'opening_book/opening_book_1.csv'
+opening_index_file = 'opening_book/opening_index.npz'
+use_opening_index_as_book = True  # Also pick book moves from the named openings
+opening_book_seed = None  # Seed for picking book moves, set to a number to get the same book moves every run
+opening_move_delay = (0.5, 1.5)  # Min and max seconds the GUI waits before playing an AI book move, None for no delay
+
 # Set to True if you want to see static evaluation for current position
 static_evaluation = False
 
@@ -34,6 +46,12 @@ start_fen = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
 timing = False
 timing_sort = 'tottime'  # Chose what to sort timing on. See options here: https://blog.alookanalytics.com/2017/03/21/python-profiling-basics/
 
+# Append search statistics (nodes, cutoffs, prunes, NPS etc.) for each AI move as JSON lines to this file. Set to None to disable
+search_stats_file = None
+
+# Set to True to print depth, nodes and time for each search iteration in the GUI
+print_search_info = True
+
 # Sounds
 toggle_sound = True  # Set to False to disable sound
 
@@ -53,6 +71,9 @@ fen_letters = {'a': '1',
 fen_numbers = {'3': '7',
                '6': '4'}
 
+# Number of serialized board rows kept in memory when creating FENs
+fen_row_cache_size = 10000
+
 # FEN representation to board pieces
 fen_to_piece = {'p': 'bp',
                 'n': 'bN',
@@ -256,7 +277,36 @@ start_board = {0: 'FF',   1: 'FF',   2: 'FF',   3: 'FF',   4: 'FF',   5: 'FF',
 
 mvv_storing = 10  # How many of the MVV_LVV top candidates to use
 no_of_killer_moves = 2  # Number of killer moves stored per depth
-R = 2  # Null move reduction of depth
+eval_cache_size_bits = 18  # The evaluation cache holds 2^x positions
+pawn_cache_size_bits = 14  # The pawn structure cache holds 2^x pawn structures
+lazy_eval_margin = 400  # Max score the terms other than piece values are assumed to add, used to skip the full evaluation
+drawish_endgame_scale = 0.25  # Score factor for a side without pawns that is at most a minor piece up in material
+use_bitbases = True  # Probe the KPK bitbase in the evaluation and search, generated on first use (takes a while) and then saved
+bitbase_folder = 'bitbase'
+bitbase_win_bonus = 800  # Added to the evaluation of the winning side in a won KPK position
+syzygy_folder = 'syzygy'  # Opened once, the first time a position is probed
+syzygy_cache_size = 100000  # Number of WDL and of DTZ probe results kept in memory
+syzygy_probe_threads = 0  # Threads for probing all root moves at once, 0 or 1 probes them one by one
+use_syzygy_in_search = True  # Probe the WDL tables in the search after captures and pawn moves
+syzygy_probe_pieces = 5  # Max number of pieces (kings included) for probing in the search, at most 5
+syzygy_probe_depth = 1  # Min depth left for probing in the search
+tablebase_win_score = 9000  # Score of a tablebase win in the search. Above normal evaluations, below 1e6 so the futility and
+# reverse futility mate guards (abs(beta) < 1e6) still apply, and below the 10000 where iterative deepening stops (mate scores are 1e9 + depth)
+R = 2  # Null move base reduction of depth
+null_move_depth_divisor = 6  # Null move reduction increases by 1 for every x depth left to search
+null_move_eval_divisor = 200  # Null move reduction increases by 1 for every x centipawns static eval is above beta
+null_move_max_eval_reduction = 3  # Max extra reduction from static eval being above beta
+null_move_verification_depth = 6  # Null move cutoffs are verified by a reduced search from this depth and above
+
+# Pruning close to the leaves, margins are given in centipawns and indexed by remaining depth
+futility_depth = 2  # Max remaining depth where futility, reverse futility and razoring are tried
+futility_margin = [0, 200, 500]  # Skip quiet moves if static eval + margin can't reach alpha
+reverse_futility_margin = 120  # Per depth, return static eval early if static eval - margin is still above beta
+razoring_margin = [0, 300, 550]  # Drop into quiescence search if static eval + margin is below alpha
+
+# Internal iterative deepening, used in PV nodes without a best move in the transposition table
+iid_depth = 4  # Min remaining depth to do the reduced search
+iid_reduction = 2  # Depth reduction of the reduced search
 
 
 # Piece base values
@@ -479,6 +529,8 @@ rook_pawn_punishment = -2  # Rooks worse with lots of pawns
 
 center_attack_bonus_factor = 1  # Factor to multiply with how many center squares are attacked by own pieces
 king_attack_bonus_factor = 5  # Factor to multiply with how many squares around enemy king that are attacked by own pieces
+use_attack_terms = False  # Calculate attack maps in the evaluation for the king attack, center attack and mobility terms
+lazy_eval_attack_margin = 300  # Added to lazy_eval_margin when the attack terms are used
 
 # If down in material, punish exchanging material. And the opposite if up in material
 # Add king_end piece table to logic (e.g. if no queens on the board or only queens and pawns)
@@ -495,6 +547,15 @@ king_attack_bonus_factor = 5  # Factor to multiply with how many squares around
 # Mobility per piece, e.g. give larger punishment if queen is less mobile. And difference punishment depending on state of game.
 # Move same piece twice in opening punishment.
 
+# Replace the evaluation parameters above with the ones written by texel_tuner.py
+use_tuned_parameters = False
+if use_tuned_parameters:
+    from tuned_parameters import *
+
+# Evaluate positions with a NNUE style network (nnue.py) instead of the evaluation above. Needs NumPy and a weights file.
+use_nnue = False
+nnue_weights_file = 'nnue/weights.npz'
+
 
 #  --------------------------------------------------------------------------------
 #                    Pre-calculated tables to speed up game
@@ -539,3 +600,23 @@ center_attacks = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
                   0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
                   0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
 
+
+# Squares attacked from each square by pawns (white, black), knights and kings, used for the attack terms in the evaluation
+pawn_attack_squares = [{}, {}]
+knight_attack_squares = {}
+for square in real_board_squares:
+    pawn_attack_squares[0][square] = [square + d for d in (-11, -9) if square + d in real_board_squares]
+    pawn_attack_squares[1][square] = [square + d for d in (9, 11) if square + d in real_board_squares]
+    knight_attack_squares[square] = [square + d for d in knight_moves if square + d in real_board_squares]
+
+# Squares in each direction from a square until the edge of the board, for sliding pieces. Same order as directions.
+ray_squares = {}
+for square in real_board_squares:
+    ray_squares[square] = []
+    for d in directions:
+        ray = []
+        attack_square = square + d
+        while attack_square in real_board_squares:
+            ray.append(attack_square)
+            attack_square += d
+        ray_squares[square].append(ray)
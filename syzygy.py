@@ -1,107 +1,206 @@
 import chess
 import chess.syzygy
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import time
+import os
 
-import fen_handling as fh
+import settings as s
 
+# Opened the first time a position is probed and then kept open. python-chess only memory maps a table file the first time it is used.
+tablebase = None
 
-def find_endgame_move(gamestate):
+# Threads for probing the root moves, they share the open tablebase
+probe_pool = None
+
+# python-chess square (a1 = 0) of each square on the 120 square board, and the bitboard of the rook for each castling right
+square_index = {square: 8 * (9 - square // 10) + square % 10 - 1 for square in s.real_board_squares}
+castling_bits = {'K': chess.BB_H1, 'Q': chess.BB_A1, 'k': chess.BB_H8, 'q': chess.BB_A8}
+
+# Probe results by Zobrist key, the least recently used result is removed when a cache is full
+wdl_cache = OrderedDict()
+dtz_cache = OrderedDict()
+
+# Number of probes, how many of them that were found in a cache, how many that had no table and the time spent on the ones
+# that were probed
+probe_stats = {'probes': 0, 'hits': 0, 'missing': 0, 'time': 0}
+
+
+def index_tables(folder):
+
+    # Material signature (white pieces v black pieces, e.g. KRPvKP) to the tables that are available for it, {'wdl', 'dtz'}.
+    # Table files are named with either side first, so both are added.
+    tables = {}
+    for file in os.listdir(folder) if os.path.isdir(folder) else []:
+        name, extension = os.path.splitext(file)
+        if extension in ('.rtbw', '.rtbz') and name.count('v') == 1:
+            white, black = name.split('v')
+            for signature in (name, f'{black}v{white}'):
+                tables.setdefault(signature, set()).add('wdl' if extension == '.rtbw' else 'dtz')
+    return tables
+
+
+tables = index_tables(s.syzygy_folder)
+
+
+def has_table(gamestate, table):
+    return table in tables.get(gamestate.material['signature'], ())
+
+
+def probe_wdl(gamestate):
+    return probe(gamestate, wdl_cache, 'wdl')
+
+
+def probe_dtz(gamestate):
+    return probe(gamestate, dtz_cache, 'dtz')
+
+
+def probe(gamestate, cache, table):
 
-    # Get fen and Python-Chess board from the given gamestate
-    fen = fh.gamestate_to_fen(gamestate)
-    board = chess.Board(fen)
+    is_known, result = lookup(gamestate, cache, table)
+    if is_known:
+        return result
 
-    with chess.syzygy.open_tablebase('syzygy') as tablebase:
-        best_dtz = tablebase.get_dtz(board)
-        best_wdl = tablebase.get_wdl(board)
+    start_time = time.time()
+    result = probe_board(gamestate_to_board(gamestate), table)
+    store(cache, gamestate.zobrist_key, result)
+    probe_stats['time'] += time.time() - start_time
 
-    # If finding a winning position in the tablebases, find the move that lowers the distance to zero (DTZ)
-    if best_wdl in (1, 2):
+    return result
 
-        # Find all possible moves and try them to see if it lowers original dtz
-        valid_moves = gamestate.get_valid_moves()
-        best_move = valid_moves[0]
-        for move in valid_moves:
 
-            piece_captured = gamestate.board[move[1]]
-            gamestate.make_move(move)
-            fen = fh.gamestate_to_fen(gamestate)
-            board = chess.Board(fen)
+def lookup(gamestate, cache, table):
 
-            with chess.syzygy.open_tablebase('syzygy') as tablebase:
-                new_dtz = tablebase.get_dtz(board)
-                new_wdl = tablebase.get_wdl(board)
+    # Returns (True, result) if the result is known without probing the tables, else (False, None)
+    probe_stats['probes'] += 1
 
-            # If winning position
-            if new_wdl in (-1, -2):
-                # If finding winning capture or pawn move, play that immediately
-                if gamestate.piece_moved[1] == 'p' or piece_captured != '--':
-                    gamestate.unmake_move()
-                    return move, 1e9, best_dtz
-                else:
-                    if abs(new_dtz) <= abs(best_dtz):
-                        best_dtz = new_dtz
-                        best_move = move
+    # Positions without a table are rejected from the index, without opening anything
+    if not has_table(gamestate, table):
+        probe_stats['missing'] += 1
+        return True, None
 
-            gamestate.unmake_move()
+    key = gamestate.zobrist_key
+    if key in cache:
+        probe_stats['hits'] += 1
+        cache.move_to_end(key)
+        return True, cache[key]
 
-        return best_move, 1e9, best_dtz
+    return False, None
 
-    # If finding a losing position in the tablebases, try to play as difficult as possible
-    if best_wdl in (-1, -2):
 
-        # Find all possible moves and try them to see if it lowers original dtz
-        valid_moves = gamestate.get_valid_moves()
-        best_dtz = 0
-        for move in valid_moves:
+def store(cache, key, result):
+    cache[key] = result
+    if len(cache) > s.syzygy_cache_size:
+        cache.popitem(last=False)
 
-            gamestate.make_move(move)
-            fen = fh.gamestate_to_fen(gamestate)
-            board = chess.Board(fen)
 
-            with chess.syzygy.open_tablebase('syzygy') as tablebase:
-                new_dtz = tablebase.get_dtz(board)
-                new_wdl = tablebase.get_wdl(board)
+def probe_board(board, table):
 
-            # If suddenly winning, play that immediately
-            if new_wdl in (0, -1, -2):
-                gamestate.unmake_move()
-                return move, -1e9, best_dtz
+    # None if the position is not in the tablebases
+    return open_tablebase().get_wdl(board) if table == 'wdl' else open_tablebase().get_dtz(board)
 
-            # Else maximize DTZ
-            if new_wdl in (1, 2):
-                if abs(new_dtz) > abs(best_dtz):
-                    best_dtz = new_dtz
-                    best_move = move
 
-            gamestate.unmake_move()
+def open_tablebase():
+    global tablebase
 
-        return best_move, -1e9, best_dtz
+    if tablebase is None:
+        tablebase = chess.syzygy.open_tablebase(s.syzygy_folder)
+    return tablebase
 
-    # If draw, find move that makes it winning, or keeps drawing
-    if best_wdl == 0:
 
-        # Find all possible moves and try them to see if it lowers original dtz
-        valid_moves = gamestate.get_valid_moves()
-        for move in valid_moves:
+def gamestate_to_board(gamestate):
 
-            gamestate.make_move(move)
-            fen = fh.gamestate_to_fen(gamestate)
-            board = chess.Board(fen)
+    # python-chess board for probing, with the bitboards set directly from the GameState board instead of through a FEN
+    bitboards = {'w': 0, 'b': 0, 'p': 0, 'N': 0, 'B': 0, 'R': 0, 'Q': 0, 'K': 0}
+    for square in s.real_board_squares:
+        piece = gamestate.board[square]
+        if piece != '--':
+            bitboards[piece[0]] |= chess.BB_SQUARES[square_index[square]]
+            bitboards[piece[1]] |= chess.BB_SQUARES[square_index[square]]
 
-            with chess.syzygy.open_tablebase('syzygy') as tablebase:
-                new_wdl = tablebase.get_wdl(board)
+    board = chess.Board(None)
+    board.pawns, board.knights, board.bishops = bitboards['p'], bitboards['N'], bitboards['B']
+    board.rooks, board.queens, board.kings = bitboards['R'], bitboards['Q'], bitboards['K']
+    board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK] = bitboards['w'], bitboards['b']
+    board.occupied = bitboards['w'] | bitboards['b']
 
-            # If suddenly winning, play that immediately
-            if new_wdl in (-1, -2):
-                gamestate.unmake_move()
-                return move, 0, 10
+    board.turn = gamestate.is_white_turn
+    board.castling_rights = sum(bits for right, bits in castling_bits.items() if right in gamestate.castling_rights)
+    board.ep_square = square_index[gamestate.enpassant_square] if gamestate.enpassant_square else None
+
+    return board
+
+
+def reset_stats():
+    probe_stats['probes'] = probe_stats['hits'] = probe_stats['missing'] = probe_stats['time'] = 0
+
+
+def rank_root_moves(gamestate):
+
+    # Probes WDL and DTZ after every valid move and returns [{'move', 'wdl', 'dtz', 'zeroing'}] with the best move first.
+    # WDL and DTZ are from the point of view of the side to move, None if the position after the move couldn't be probed.
+    # Zeroing moves (captures and pawn moves) reset the 50 move rule.
+    ranked_moves, unknown = [], []
+    for move in gamestate.get_valid_moves():
+        ranked_move = {'move': move, 'wdl': None, 'dtz': None, 'zeroing': gamestate.board[move[0]][1] == 'p' or gamestate.board[move[1]] != '--'}
+        ranked_moves.append(ranked_move)
+
+        gamestate.make_move(move)
+        for table, cache in (('wdl', wdl_cache), ('dtz', dtz_cache)):
+            is_known, result = lookup(gamestate, cache, table)
+            if is_known:
+                ranked_move[table] = -result if result is not None else None
+            else:
+                unknown.append((ranked_move, table, cache, gamestate.zobrist_key, gamestate_to_board(gamestate)))
+        gamestate.unmake_move()
+
+    # Probe all positions that were not known in one go, in s.syzygy_probe_threads threads if more than 1
+    start_time = time.time()
+    open_tablebase()
+    if s.syzygy_probe_threads > 1 and len(unknown) > 1:
+        results = list(get_probe_pool().map(probe_board, [board for _, _, _, _, board in unknown], [table for _, table, _, _, _ in unknown]))
+    else:
+        results = [probe_board(board, table) for _, table, _, _, board in unknown]
+
+    for (ranked_move, table, cache, key, _), result in zip(unknown, results):
+        store(cache, key, result)
+        ranked_move[table] = -result if result is not None else None
+    probe_stats['time'] += time.time() - start_time
+
+    # Wins first, with zeroing moves and then the lowest DTZ first. Losses last, with the highest DTZ first to make it as
+    # difficult as possible. Moves that couldn't be probed are put between the draws and the losses.
+    def rank(ranked_move):
+        wdl = ranked_move['wdl'] if ranked_move['wdl'] is not None else -0.5
+        dtz = abs(ranked_move['dtz'] or 0)
+        return -wdl, not (wdl > 0 and ranked_move['zeroing']), dtz if wdl > 0 else -dtz
+
+    return sorted(ranked_moves, key=rank)
+
+
+def get_probe_pool():
+    global probe_pool
+
+    if probe_pool is None:
+        probe_pool = ThreadPoolExecutor(max_workers=s.syzygy_probe_threads)
+    return probe_pool
+
+
+def find_endgame_move(gamestate):
 
-            # Else if finding a move that keeps eval at 0, save that move and play if not finding a winning move
-            elif new_wdl == 0:
-                best_move = move
+    best_dtz = probe_dtz(gamestate)
+    best_wdl = probe_wdl(gamestate)
+    if best_wdl is None or best_dtz is None:
+        return None, None, None
 
-            gamestate.unmake_move()
+    ranked_moves = rank_root_moves(gamestate)
+    if not ranked_moves or ranked_moves[0]['wdl'] is None:
+        return None, None, None
 
-        return best_move, 0, 10
+    # Winning, losing (as difficult as possible for the opponent) or drawing move
+    best_move = ranked_moves[0]
+    if best_move['wdl'] > 0:
+        return best_move['move'], 1e9, best_dtz
+    if best_move['wdl'] < 0:
+        return best_move['move'], -1e9, best_dtz
 
-    return None, None
+    return best_move['move'], 0, 10
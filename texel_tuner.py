@@ -0,0 +1,279 @@
+#  --------------------------------------------------------------------------------------------------
+#                                Texel tuning
+#
+#  Tunes the evaluation parameters in settings.py (piece values, piece-square tables and the
+#  bonus/punishment terms) on a corpus of positions with known game results.
+#
+#  The corpus is an EPD file with one position per line and the result from white's point of view,
+#  either as 'c9 "1-0";' / '"0-1"' / '"1/2-1/2"' or as '[1.0]' / '[0.0]' / '[0.5]'. Quiet positions
+#  (no captures or checks available) give the best result.
+#
+#  The evaluation is linear in all tuned parameters, so the features of each position are extracted
+#  once into a sparse matrix which is cached in the folder 'test_positions/tuning_cache'. Re-tuning
+#  on the same corpus only runs the gradient descent. Drawish endgames, where the evaluation scales
+#  down the score of the side that is ahead, are not linear and are left out of the tuning.
+#
+#  The tuned values are written to a parameter module, used by setting use_tuned_parameters = True
+#  in settings.py.
+#  ---------------------------------------------------------------------------------------------------
+
+import settings as s
+import batch_evaluation as be
+
+import numpy as np
+import hashlib
+import os
+import re
+import time
+from datetime import datetime
+
+epd_file = 'test_positions/tuning.epd'
+feature_cache_folder = 'test_positions/tuning_cache'
+output_module = 'tuned_parameters.py'
+
+chunk_size = 100000  # Positions read and feature extracted at a time
+epochs = 1000  # Number of gradient descent steps
+learning_rate = 1  # Adam step size, in centipawns
+print_every = 50  # Print the error every x epochs
+
+# Names of the tuned bonus/punishment terms in settings.py
+term_names = ['bishop_pair_bonus', 'double_pawn_punishment', 'isolated_pawn_punishment', 'rook_on_semi_open_file_bonus',
+              'rook_on_open_file_bonus', 'blocking_d_e_pawn_punishment', 'knight_endgame_punishment', 'bishop_endgame_bonus',
+              'knight_pawn_bonus', 'bishop_pawn_punishment', 'rook_pawn_punishment']
+
+# Names of the piece-square tables in settings.py
+table_names = {'K': 'king', 'Q': 'queen', 'R': 'rook', 'B': 'bishop', 'N': 'knight', 'p': 'pawn'}
+
+fen_piece_codes = {'P': 1, 'N': 2, 'B': 3, 'R': 4, 'Q': 5, 'K': 6, 'p': 7, 'n': 8, 'b': 9, 'r': 10, 'q': 11, 'k': 12}  # Same as be.piece_codes
+results = {'1-0': 1, '0-1': 0, '1/2-1/2': 0.5, '[1.0]': 1, '[0.0]': 0, '[0.5]': 0.5, '[1]': 1, '[0]': 0}
+
+
+class TexelTuner:
+
+    def __init__(self):
+
+        # Parameters as [(settings name, key)], key is the piece for base values and (piece, square) for the tables.
+        # The king base value is not tuned since both sides always have one king.
+        self.parameters = []
+        for name in ['piece_value_base_mid_game', 'piece_value_base_end_game']:
+            self.parameters += [(name, piece) for piece in 'QRBNp']
+        for name in ['piece_value_mid_game', 'piece_value_end_game']:
+            self.parameters += [(name, (piece, square)) for piece in 'KQRBNp' for square in s.real_board_squares]
+        self.parameters += [(name, None) for name in term_names]
+
+        self.weights = np.array([self.get_value(name, key) for name, key in self.parameters], dtype=np.float64)
+        column = {parameter: i for i, parameter in enumerate(self.parameters)}
+
+        # Column of the base value and table value for each phase (mid, end), piece code and square in a position
+        self.base_columns = np.full((2, 13), -1)
+        self.table_columns = np.full((2, 13, 64), -1)
+        for phase, (base_name, table_name) in enumerate([('piece_value_base_mid_game', 'piece_value_mid_game'),
+                                                         ('piece_value_base_end_game', 'piece_value_end_game')]):
+            for piece, code in be.piece_codes.items():
+                if piece != '--':
+                    self.base_columns[phase, code] = column.get((base_name, piece[1]), -1)
+                    for i, square in enumerate(s.real_board_squares):
+                        square = square if piece[0] == 'w' else 120 - square + s.flip_board[square % 10]
+                        self.table_columns[phase, code, i] = column[(table_name, (piece[1], square))]
+
+        self.term_columns = {name: column[(name, None)] for name in term_names}
+
+        # Sparse feature matrix as rows, columns and values, and the game result of each position
+        self.rows, self.columns, self.values, self.results = None, None, None, None
+        self.k = 1
+
+    def get_value(self, name, key):
+        if name in term_names:
+            return getattr(s, name)
+        if name.startswith('piece_value_base'):
+            return getattr(s, name)[key]
+        return getattr(s, name)[key[0]][key[1]]
+
+# ---------------------------------------------------------------------------------------------------------
+#                                  Feature extraction
+# ---------------------------------------------------------------------------------------------------------
+
+    def load_features(self):
+
+        # Cache file depends on the corpus file and on the tuned parameters
+        corpus_stat = os.stat(epd_file)
+        cache_id = hashlib.md5(f'{os.path.abspath(epd_file)}{corpus_stat.st_size}{corpus_stat.st_mtime}{self.parameters}without scaled'.encode()).hexdigest()
+        cache_file = f'{feature_cache_folder}/{os.path.basename(epd_file)}_{cache_id[:12]}.npz'
+
+        if os.path.exists(cache_file):
+            data = np.load(cache_file)
+            self.rows, self.columns, self.values, self.results = data['rows'], data['columns'], data['values'], data['results']
+            print(f'Loaded features for {len(self.results)} positions from {cache_file}')
+            return
+
+        start_time = time.time()
+        rows, columns, values, results_list = [], [], [], []
+        number_of_positions = skipped_positions = 0
+        for positions, chunk_results in self.read_corpus():
+
+            # Positions in scaled endgames don't fit the linear model
+            is_used = ~be.is_scaled(positions)
+            skipped_positions += len(positions) - is_used.sum()
+            positions, chunk_results = positions[is_used], chunk_results[is_used]
+
+            chunk_rows, chunk_columns, chunk_values = self.extract_features(positions)
+            rows.append(chunk_rows + number_of_positions)
+            columns.append(chunk_columns)
+            values.append(chunk_values)
+            results_list.append(chunk_results)
+            number_of_positions += len(positions)
+            print(f'{number_of_positions} positions extracted')
+
+        self.rows = np.concatenate(rows).astype(np.int32)
+        self.columns = np.concatenate(columns).astype(np.int16)
+        self.values = np.concatenate(values).astype(np.float32)
+        self.results = np.concatenate(results_list)
+
+        os.makedirs(feature_cache_folder, exist_ok=True)
+        np.savez(cache_file, rows=self.rows, columns=self.columns, values=self.values, results=self.results)
+        print(f'Extracted features for {number_of_positions} positions in {round(time.time() - start_time, 1)} s, saved to {cache_file}')
+        print(f'{skipped_positions} positions in scaled endgames were left out')
+
+    def read_corpus(self):
+
+        # Stream the corpus and yield (positions, results) arrays of at most chunk_size positions
+        positions, chunk_results = [], []
+        with open(epd_file, 'r') as file:
+            for line in file:
+                result = re.search(r'1-0|0-1|1/2-1/2|\[[01](?:\.[05])?\]', line)
+                if not result:
+                    continue
+                positions.append(self.fen_to_array(line.split()[0]))
+                chunk_results.append(results[result.group()])
+
+                if len(positions) == chunk_size:
+                    yield np.array(positions), np.array(chunk_results, dtype=np.float32)
+                    positions, chunk_results = [], []
+
+        if positions:
+            yield np.array(positions), np.array(chunk_results, dtype=np.float32)
+
+    @staticmethod
+    def fen_to_array(fen_board):
+        squares = []
+        for item in fen_board:
+            if item.isdigit():
+                squares += [0] * int(item)
+            elif item != '/':
+                squares.append(fen_piece_codes[item])
+        return squares
+
+    def extract_features(self, positions):
+
+        # Feature values are from white's point of view (white count - black count), weighted with the game phase
+        positions = positions.astype(np.intp)
+        counts = be.piece_counts(positions)
+        midgame, endgame = be.game_phase(counts)
+
+        # Base and table values, one entry per piece and phase
+        position_index, square_index = np.nonzero(positions)
+        codes = positions[position_index, square_index]
+        sign = np.where(codes <= 6, 1, -1)
+        rows, columns, values = [], [], []
+        for phase, phase_weight in enumerate([midgame, endgame]):
+            weight = sign * phase_weight[position_index]
+            rows += [position_index, position_index]
+            columns += [self.table_columns[phase, codes, square_index], self.base_columns[phase, codes]]
+            values += [weight, weight]
+
+        # Bonus/punishment terms
+        for name, (white, black) in be.term_counts(positions, counts, endgame).items():
+            if name in self.term_columns:
+                value = np.asarray(white, dtype=np.float64) - black
+                nonzero = np.nonzero(value)[0]
+                rows.append(nonzero)
+                columns.append(np.full(len(nonzero), self.term_columns[name]))
+                values.append(value[nonzero])
+
+        rows, columns, values = np.concatenate(rows), np.concatenate(columns), np.concatenate(values)
+        used = (columns >= 0) & (values != 0)
+
+        return rows[used], columns[used], values[used]
+
+# ---------------------------------------------------------------------------------------------------------
+#                                  Tuning
+# ---------------------------------------------------------------------------------------------------------
+
+    def scores(self, weights):
+        return np.bincount(self.rows, weights=self.values * weights[self.columns], minlength=len(self.results))
+
+    def error(self, weights, k):
+        return np.mean((self.results - 1 / (1 + 10 ** (-k * self.scores(weights) / 400))) ** 2)
+
+    def find_k(self):
+
+        # Scaling constant for the sigmoid that fits the current parameters best, found by narrowing down a scan
+        low, high = 0.0, 3.0
+        for _ in range(4):
+            candidates = np.linspace(low, high, 11)
+            errors = [self.error(self.weights, k) for k in candidates]
+            best = candidates[int(np.argmin(errors))]
+            step = candidates[1] - candidates[0]
+            low, high = max(0.0, best - step), best + step
+        self.k = best
+        print(f'K = {round(self.k, 4)}, error = {round(min(errors), 6)}')
+
+    def tune(self):
+
+        # Full batch gradient descent with Adam on the mean squared error between result and sigmoid(score)
+        weights = self.weights.copy()
+        m, v = np.zeros_like(weights), np.zeros_like(weights)
+        beta_1, beta_2 = 0.9, 0.999
+        c = self.k * np.log(10) / 400
+
+        for epoch in range(1, epochs + 1):
+            sigmoid = 1 / (1 + 10 ** (-self.k * self.scores(weights) / 400))
+            gradient_per_position = -2 * (self.results - sigmoid) * sigmoid * (1 - sigmoid) * c / len(self.results)
+            gradient = np.bincount(self.columns, weights=self.values * gradient_per_position[self.rows], minlength=len(weights))
+
+            m = beta_1 * m + (1 - beta_1) * gradient
+            v = beta_2 * v + (1 - beta_2) * gradient ** 2
+            weights -= learning_rate * (m / (1 - beta_1 ** epoch)) / (np.sqrt(v / (1 - beta_2 ** epoch)) + 1e-12)
+
+            if epoch % print_every == 0 or epoch == epochs:
+                print(f'Epoch {epoch}/{epochs}, error = {round(self.error(weights, self.k), 6)}')
+
+        self.weights = weights
+
+    def write_module(self):
+
+        tuned = {parameter: int(round(weight)) for parameter, weight in zip(self.parameters, self.weights)}
+
+        lines = ['#  --------------------------------------------------------------------------------',
+                 f'#     Evaluation parameters tuned by texel_tuner.py on {epd_file}, {datetime.now().strftime("%Y-%m-%d %H:%M")}',
+                 '#  --------------------------------------------------------------------------------', '']
+
+        for name in ['piece_value_base_mid_game', 'piece_value_base_end_game']:
+            values = {piece: tuned.get((name, piece), getattr(s, name)[piece]) for piece in 'KQRBNp'}
+            lines += [f'{name} = {values}', '']
+
+        for name, suffix in [('piece_value_mid_game', 'mid'), ('piece_value_end_game', 'end')]:
+            for piece, table_name in table_names.items():
+                table = getattr(s, name)[piece][:]
+                for square in s.real_board_squares:
+                    table[square] = tuned[(name, (piece, square))]
+                rows = [', '.join(f'{value:4}' for value in table[i:i + 10]) for i in range(0, len(table), 10)]
+                lines += [f'{table_name}_{suffix} = [' + (',\n' + ' ' * (len(table_name) + len(suffix) + 5)).join(rows) + ']']
+            lines += [f'{name} = {{' + ', '.join(f"'{piece}': {table_name}_{suffix}" for piece, table_name in table_names.items()) + '}', '']
+
+        lines += [f'{name} = {tuned[(name, None)]}' for name in term_names]
+
+        with open(output_module, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        print(f'Tuned parameters written to {output_module}')
+
+
+#  --------------------------------------------------------------------------------
+#                             Run tuning
+#  --------------------------------------------------------------------------------
+
+tuner = TexelTuner()
+tuner.load_features()
+tuner.find_k()
+tuner.tune()
+tuner.write_module()